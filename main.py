@@ -1,34 +1,170 @@
 import asyncio
+import hashlib
+import json
+import logging
 import os
+import random
+import signal
+import time
+import unicodedata
+import uuid
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
 from dataclasses import dataclass
-from typing import Iterable, Optional
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterable, Iterator, Mapping, Optional, Union
 from urllib.parse import quote
 
+import aiohttp
 import asyncpg
-from aiogram import Bot, Dispatcher, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, Router
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+from aiogram.dispatcher.event.handler import CallableObject
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
 from aiogram.enums import ParseMode
-from aiogram.filters import CommandStart
+from aiogram.exceptions import (
+    TelegramAPIError,
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+from aiogram.filters import CommandObject, CommandStart, ExceptionTypeFilter, Filter, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.methods import AnswerCallbackQuery, Response, TelegramMethod
 from aiogram.types import (
+    BufferedInputFile,
     CallbackQuery,
+    ErrorEvent,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     KeyboardButton,
+    MaybeInaccessibleMessageUnion,
     Message,
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove,
+    TelegramObject,
+    Update,
+    User,
 )
-from aiohttp import web
+from aiohttp import FormData, web
 from dotenv import load_dotenv
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
 
 load_dotenv()
 
 BOT_TOKEN = (os.getenv("BOT_TOKEN", "") or "").strip()
 DATABASE_URL = (os.getenv("DATABASE_URL", "") or "").strip()
+# Прямой адрес Postgres в обход PgBouncer — для LISTEN и долгих выделенных соединений
+DATABASE_DIRECT_URL = (os.getenv("DATABASE_DIRECT_URL", "") or "").strip() or DATABASE_URL
+
+# Пул соединений
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_POOL_MAX_INACTIVE_LIFETIME", "300"))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "10"))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "10"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+# PgBouncer в режиме transaction: prepared statements между запросами не живут
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "0") == "1"
+# Ожидание соединения дольше этого (сек) пишем в лог
+DB_SLOW_ACQUIRE = float(os.getenv("DB_SLOW_ACQUIRE", "0.5"))
+DB_CONNECT_TIMEOUT = float(os.getenv("DB_CONNECT_TIMEOUT", "10"))
+# Автомат: после стольких сбоев подряд не ходим в БД DB_BREAKER_COOLDOWN секунд
+DB_BREAKER_FAILURES = int(os.getenv("DB_BREAKER_FAILURES", "3"))
+DB_BREAKER_COOLDOWN = float(os.getenv("DB_BREAKER_COOLDOWN", "10"))
+
+# Если задан — /metrics отдаётся только с заголовком Authorization: Bearer <token>
+METRICS_TOKEN = (os.getenv("METRICS_TOKEN", "") or "").strip()
+
+# Трассировка апдейтов: лог медленнее порога (мс) и полная запись спанов для доли апдейтов
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "500"))
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+
+# Обработка апдейтов: сколько выполняется одновременно (по разным чатам) и сколько
+# может быть принято в работу всего — при заполнении polling перестаёт забирать новые
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "16"))
+UPDATE_QUEUE_LIMIT = max(UPDATE_WORKERS, int(os.getenv("UPDATE_QUEUE_LIMIT", "100")))
+
+# Последний удачно загруженный снимок меню (формат как у «📦 Экспорт»): перезаписывается
+# после каждой загрузки из БД; если БД при старте недоступна, меню поднимается из него
+# в режиме «только чтение». Пустое значение — снимок не пишется и не читается.
+MENU_SNAPSHOT_PATH = os.getenv("MENU_SNAPSHOT_PATH", "menu_snapshot.json").strip()
+
+# Сколько webhook, пришедший во время старта, ждёт готовности бота (сек), прежде чем получить 503
+STARTUP_WEBHOOK_WAIT = float(os.getenv("STARTUP_WEBHOOK_WAIT", "50"))
+
+# /readyz: предельная задержка event loop (сек), возраст последнего getUpdates в режиме
+# polling (сек) и таймаут проверочного запроса к БД. READY_REQUIRE_DB=0 — без БД бот
+# всё равно отвечает из снимка меню, поэтому её недоступность readiness не роняет.
+# /livez падает только при задержке loop больше LIVEZ_MAX_LOOP_LAG.
+READY_MAX_LOOP_LAG = float(os.getenv("READY_MAX_LOOP_LAG", "1"))
+READY_MAX_UPDATES_AGE = float(os.getenv("READY_MAX_UPDATES_AGE", "60"))
+READY_DB_TIMEOUT = float(os.getenv("READY_DB_TIMEOUT", "2"))
+READY_REQUIRE_DB = os.getenv("READY_REQUIRE_DB", "0") == "1"
+LIVEZ_MAX_LOOP_LAG = float(os.getenv("LIVEZ_MAX_LOOP_LAG", "5"))
+
+# Прогрев: раз в KEEP_WARM_INTERVAL сек (0 — выключено) дёргаем пул и свой публичный
+# адрес — бесплатный план Render усыпляет сервис после 15 минут без входящих запросов
+KEEP_WARM_INTERVAL = float(os.getenv("KEEP_WARM_INTERVAL", "0"))
+KEEP_WARM_URL = (
+    (os.getenv("KEEP_WARM_URL", "") or os.getenv("RENDER_EXTERNAL_URL", "") or "").strip().rstrip("/")
+)
+
+# Остановка по SIGTERM: сколько ждать доработки уже принятых апдейтов (сек). Render
+# после SIGTERM ждёт 30 с до SIGKILL — остаток уходит на сброс буферов и закрытие пула
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "20"))
+
+# Свой адрес Bot API (локальный telegram-bot-api или фейковый сервер из loadtest.py)
+TELEGRAM_API_URL = (os.getenv("TELEGRAM_API_URL", "") or "").strip().rstrip("/")
+
 OWNER_ID = int(os.getenv("OWNER_ID", "0") or "0")
 
+# Webhook включается, если задан публичный адрес сервиса (например, https://<app>.onrender.com)
+WEBHOOK_BASE_URL = (os.getenv("WEBHOOK_BASE_URL", "") or "").strip().rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook") or "/webhook"
+# Секрет должен совпадать на всех репликах, поэтому по умолчанию выводим его из токена
+WEBHOOK_SECRET = (os.getenv("WEBHOOK_SECRET", "") or "").strip() or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+# 1 — отвечать методом прямо в теле ответа на webhook (без отдельного запроса к API)
+WEBHOOK_INLINE_ANSWERS = os.getenv("WEBHOOK_INLINE_ANSWERS", "1") == "1"
+# При нескольких репликах / zero-downtime деплое снимать webhook на остановке нельзя:
+# старый инстанс снимет его уже после того, как новый его поставил
+WEBHOOK_DELETE_ON_SHUTDOWN = os.getenv("WEBHOOK_DELETE_ON_SHUTDOWN", "0") == "1"
+
+# Аналитика кликов: буфер событий навигации пишется в nav_events пачками (COPY)
+CLICKS_FLUSH_INTERVAL = float(os.getenv("CLICKS_FLUSH_INTERVAL", "5"))
+CLICKS_FLUSH_BATCH = int(os.getenv("CLICKS_FLUSH_BATCH", "1000"))
+# при недоступной БД старые события вытесняются новыми сверх этого размера
+CLICKS_BUFFER_MAX = int(os.getenv("CLICKS_BUFFER_MAX", "100000"))
+# 1 — url-кнопки ведут через /go/<id> на нашем сервере, чтобы считать клики (нужен WEBHOOK_BASE_URL)
+TRACK_URL_CLICKS = os.getenv("TRACK_URL_CLICKS", "0") == "1" and bool(WEBHOOK_BASE_URL)
+
+# Навигация по inline-кнопкам: 1 — редактируем текущее сообщение, 0 — шлём новое
+NAV_EDIT_IN_PLACE = os.getenv("NAV_EDIT_IN_PLACE", "1") == "1"
+
+# Лимиты Telegram на исходящие сообщения (в секунду)
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))
+TG_GROUP_RATE = float(os.getenv("TG_GROUP_RATE", str(20 / 60)))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "3"))
+
+# Как часто сбрасывать накопленные визиты пользователей в БД (сек) и максимальный размер пачки
+USERS_FLUSH_INTERVAL = float(os.getenv("USERS_FLUSH_INTERVAL", "5"))
+USERS_FLUSH_BATCH = int(os.getenv("USERS_FLUSH_BATCH", "500"))
+# Сколько получателей рассылки читать из курсора за раз (и как часто сохранять прогресс)
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "200"))
+
+# FSM: сколько живёт незавершённый шаг админки и сколько помним «у пользователя состояния нет»
+FSM_TTL = float(os.getenv("FSM_TTL_HOURS", "24")) * 3600
+FSM_NEGATIVE_TTL = float(os.getenv("FSM_NEGATIVE_TTL", "30"))
+
 CHANNEL_URL = "https://t.me/ozonbluerise"
 CONSULT_FORM_URL = os.getenv(
     "CONSULTATION_FORM_URL",
@@ -65,8 +201,824 @@ def paylink_prefill(course_title: str) -> str:
     return f"Здравствуйте! Нужна ссылка на оплату по карте или СБП за курс «{course_title}»."
 
 
-dp = Dispatcher()
+logger = logging.getLogger("bot")
+
 POOL: Optional[asyncpg.Pool] = None
+# Выставляется, когда меню загружено и бот готов отвечать
+READY = asyncio.Event()
+# Выставляется по SIGTERM/SIGINT: новые апдейты больше не принимаем
+STOPPING = asyncio.Event()
+# monotonic-время последнего удачного getUpdates или принятого webhook
+LAST_UPDATES_AT = 0.0
+LAST_LOOP_LAG = 0.0
+
+
+# ===== Metrics =====
+UPDATES_TOTAL = Counter("bot_updates_total", "Updates received", ["type"])
+UPDATE_SECONDS = Histogram("bot_update_seconds", "Full update processing time", ["type"])
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Handler execution time", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Exceptions raised by handlers", ["handler"])
+DB_QUERY_SECONDS = Histogram("bot_db_query_seconds", "DB call time including pool acquire", ["query"])
+DEEPLINK_STARTS = Counter("bot_deeplink_starts_total", "/start with a payload", ["result"])
+MENU_LOOKUPS = Counter("bot_menu_lookups_total", "Menu lookups by source", ["op", "source"])
+TG_REQUEST_SECONDS = Histogram("bot_telegram_request_seconds", "Bot API request latency", ["method"])
+TG_REQUEST_ERRORS = Counter("bot_telegram_errors_total", "Bot API request errors", ["method", "error"])
+SEND_WAIT_SECONDS = Histogram("bot_send_queue_wait_seconds", "Time spent in the send scheduler", ["priority"])
+DB_ACQUIRE_SECONDS = Histogram("bot_db_pool_acquire_seconds", "Time waiting for a pool connection")
+LOOP_LAG = Gauge("bot_event_loop_lag_seconds", "Last measured event loop lag")
+LOOP_LAG_SECONDS = Histogram(
+    "bot_event_loop_lag_distribution_seconds",
+    "Event loop lag samples",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+Gauge("bot_db_pool_size", "Open pool connections").set_function(lambda: POOL.get_size() if POOL else 0)
+Gauge("bot_db_pool_idle", "Idle pool connections").set_function(lambda: POOL.get_idle_size() if POOL else 0)
+Gauge("bot_db_pool_in_use", "Pool connections in use").set_function(lambda: POOL_STATS.in_use)
+Gauge("bot_db_pool_waiting", "Tasks waiting for a pool connection").set_function(lambda: POOL_STATS.waiting)
+Gauge("bot_db_pool_timeouts", "Pool acquire timeouts since start").set_function(lambda: POOL_STATS.timeouts)
+Gauge("bot_send_queue_interactive", "Interactive requests waiting in the scheduler").set_function(
+    lambda: SEND_SCHEDULER.waiting[PRIORITY_INTERACTIVE]
+)
+Gauge("bot_send_queue_bulk", "Bulk requests waiting in the scheduler").set_function(
+    lambda: SEND_SCHEDULER.waiting[PRIORITY_BULK]
+)
+Gauge("bot_send_retry_after", "TelegramRetryAfter responses since start").set_function(
+    lambda: SEND_SCHEDULER.retry_after
+)
+Gauge("bot_updates_in_flight", "Updates accepted and not finished").set_function(
+    lambda: UPDATE_EXECUTOR.in_flight
+)
+Gauge("bot_updates_running", "Updates being processed by workers").set_function(lambda: UPDATE_EXECUTOR.running)
+Gauge("bot_db_circuit_open", "1 while the DB circuit breaker is open").set_function(
+    lambda: 1 if DB_CIRCUIT.is_open else 0
+)
+Gauge("bot_menu_read_only", "1 while the menu is served from the snapshot file").set_function(
+    lambda: 1 if MENU_READ_ONLY else 0
+)
+Gauge("bot_clicks_buffered", "Navigation events waiting to be written").set_function(
+    lambda: len(CLICK_RECORDER.buffer)
+)
+Gauge("bot_clicks_dropped", "Navigation events dropped on buffer overflow").set_function(
+    lambda: CLICK_RECORDER.dropped
+)
+Gauge("bot_ready", "1 once startup has finished").set_function(lambda: 1 if READY.is_set() else 0)
+STARTUP_SECONDS = Gauge("bot_startup_seconds", "Time from process start to ready")
+Gauge("bot_menu_version", "Loaded menu snapshot version").set_function(lambda: MENU.version if MENU else -1)
+
+
+def handler_name(data: dict[str, Any]) -> str:
+    # команды админки идут через один диспетчер — подписываем их настоящим хэндлером
+    handler_object = data.get("command_handler") or data.get("handler")
+    return getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+
+
+@contextmanager
+def observe_db(query: str, kind: str = "db") -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        DB_QUERY_SECONDS.labels(query).observe(duration)
+        record_span(kind, query, started, duration)
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Внешний middleware на dp.update: поток апдейтов и полное время обработки."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        update_type = event.event_type if isinstance(event, Update) else type(event).__name__
+        UPDATES_TOTAL.labels(update_type).inc()
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            UPDATE_SECONDS.labels(update_type).observe(time.perf_counter() - started)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренний middleware: время конкретного хэндлера (start, cb_node, ...)."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        name = handler_name(data)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.labels(name).inc()
+            raise
+        finally:
+            HANDLER_SECONDS.labels(name).observe(time.perf_counter() - started)
+
+
+class TelegramMetrics(BaseRequestMiddleware):
+    """Латентность и ошибки Bot API; ставится после SendScheduler, чтобы не считать очередь."""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType,
+        bot: Bot,
+        method: TelegramMethod,
+    ) -> Response:
+        name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            result = await make_request(bot, method)
+        except Exception as e:
+            TG_REQUEST_ERRORS.labels(name, type(e).__name__).inc()
+            raise
+        else:
+            if name == "getUpdates":
+                mark_updates_received()
+            return result
+        finally:
+            duration = time.perf_counter() - started
+            TG_REQUEST_SECONDS.labels(name).observe(duration)
+            record_span("telegram", name, started, duration)
+
+
+async def monitor_loop_lag(interval: float = 1.0) -> None:
+    global LAST_LOOP_LAG
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        LAST_LOOP_LAG = lag
+        LOOP_LAG.set(lag)
+        LOOP_LAG_SECONDS.observe(lag)
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return web.Response(status=401, text="unauthorized")
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+# ===== Health =====
+def mark_updates_received() -> None:
+    global LAST_UPDATES_AT
+    LAST_UPDATES_AT = time.monotonic()
+
+
+async def ping_db() -> None:
+    # мимо db_acquire: частые проверки здоровья не должны сами размыкать DB_CIRCUIT
+    # и занимать его пробный запрос — это решает только настоящий трафик
+    if POOL is None:
+        raise DbUnavailable("database is not connected")
+    with observe_db("ping"):
+        async with POOL.acquire(timeout=READY_DB_TIMEOUT) as conn:
+            await conn.fetchval("SELECT 1", timeout=READY_DB_TIMEOUT)
+
+
+async def livez(_: web.Request) -> web.Response:
+    """Процесс жив и loop не завис — иначе перезапуск поможет."""
+    if LAST_LOOP_LAG > LIVEZ_MAX_LOOP_LAG:
+        return web.Response(status=503, text=f"event loop lag {LAST_LOOP_LAG:.1f}s")
+    return web.Response(text="ok")
+
+
+async def readyz(_: web.Request) -> web.Response:
+    """Готов ли бот прямо сейчас отвечать: старт завершён, loop успевает, апдейты приходят, БД отвечает."""
+    checks: dict[str, dict[str, Any]] = {}
+    checks["startup"] = {"ok": READY.is_set() and not STOPPING.is_set(), "read_only": MENU_READ_ONLY}
+    checks["loop_lag"] = {"ok": LAST_LOOP_LAG <= READY_MAX_LOOP_LAG, "seconds": round(LAST_LOOP_LAG, 3)}
+
+    age = time.monotonic() - LAST_UPDATES_AT if LAST_UPDATES_AT else None
+    # webhook без трафика — норма, а long polling возвращается хотя бы раз в polling_timeout
+    updates_ok = bool(WEBHOOK_BASE_URL) or not READY.is_set() or (age is not None and age <= READY_MAX_UPDATES_AGE)
+    checks["updates"] = {
+        "ok": updates_ok,
+        "mode": "webhook" if WEBHOOK_BASE_URL else "polling",
+        "age_seconds": round(age, 1) if age is not None else None,
+    }
+
+    started = time.perf_counter()
+    try:
+        await ping_db()
+    except Exception as e:
+        checks["db"] = {"ok": not READY_REQUIRE_DB, "error": repr(e)}
+    else:
+        checks["db"] = {"ok": True, "ms": round((time.perf_counter() - started) * 1000, 1)}
+    checks["db"]["circuit_open"] = DB_CIRCUIT.is_open
+    if POOL is not None:
+        checks["db"].update(pool_size=POOL.get_size(), pool_idle=POOL.get_idle_size())
+
+    ready = all(check["ok"] for check in checks.values())
+    return web.json_response({"ready": ready, "checks": checks}, status=200 if ready else 503)
+
+
+async def keep_warm() -> None:
+    """Держит соединения пула и горячий запрос меню в работе, а Render — не спящим."""
+    if not KEEP_WARM_URL:
+        logger.info("KEEP_WARM_URL/RENDER_EXTERNAL_URL is not set, keep-warm pings only the database")
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
+        while True:
+            await asyncio.sleep(KEEP_WARM_INTERVAL)
+            try:
+                with observe_db("keep_warm"):
+                    async with db_acquire() as conn:
+                        await conn.fetchrow(NODE_WITH_BUTTONS_SQL, "root")
+            except (DbUnavailable, asyncio.TimeoutError, *DB_OUTAGE_ERRORS) as e:
+                logger.warning("Keep-warm database ping failed: %r", e)
+            except Exception:
+                logger.exception("Keep-warm database ping failed")
+            if not KEEP_WARM_URL:
+                continue
+            # запрос через публичный адрес: для Render это входящий трафик
+            try:
+                async with session.get(f"{KEEP_WARM_URL}/livez") as response:
+                    if response.status != 200:
+                        logger.warning("Keep-warm self-ping returned %s", response.status)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning("Keep-warm self-ping failed: %r", e)
+
+
+# ===== Tracing =====
+trace_logger = logging.getLogger("bot.trace")
+
+
+class Trace:
+    """
+    Трасса одного апдейта. Суммы по стадиям (db/fsm/telegram/...) считаются всегда —
+    это дёшево; отдельные спаны сохраняются только для сэмплированных апдейтов.
+    """
+
+    __slots__ = ("trace_id", "started", "dispatched", "sampled", "spans", "totals", "handler")
+
+    MAX_SPANS = 200
+
+    def __init__(self, sampled: bool) -> None:
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.started = time.perf_counter()
+        # когда ChatOrderedExecutor отпустил апдейт из очереди чата
+        self.dispatched = self.started
+        self.sampled = sampled
+        self.spans: list[dict[str, Any]] = []
+        self.totals: dict[str, float] = {}
+        self.handler: Optional[str] = None
+
+    def add(self, kind: str, name: str, started: float, duration: float) -> None:
+        self.totals[kind] = self.totals.get(kind, 0.0) + duration
+        if self.sampled and len(self.spans) < self.MAX_SPANS:
+            self.spans.append(
+                {
+                    "kind": kind,
+                    "name": name,
+                    "at_ms": round((started - self.started) * 1000, 2),
+                    "ms": round(duration * 1000, 2),
+                }
+            )
+
+
+CURRENT_TRACE: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+
+
+def record_span(kind: str, name: str, started: float, duration: float) -> None:
+    trace = CURRENT_TRACE.get()
+    if trace is not None:
+        trace.add(kind, name, started, duration)
+
+
+class TracingMiddleware(BaseMiddleware):
+    """
+    Самый внешний middleware на dp.update (оборачивает и встроенный FSM-middleware):
+    выдаёт trace_id и пишет JSON-лог для медленных (TRACE_SLOW_MS) и сэмплированных апдейтов.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        trace = Trace(sampled=random.random() < TRACE_SAMPLE_RATE)
+        token = CURRENT_TRACE.set(trace)
+        data["trace_id"] = trace.trace_id
+        try:
+            return await handler(event, data)
+        finally:
+            CURRENT_TRACE.reset(token)
+            total_ms = (time.perf_counter() - trace.started) * 1000
+            if total_ms >= TRACE_SLOW_MS or trace.sampled:
+                self._emit(trace, event, total_ms, slow=total_ms >= TRACE_SLOW_MS)
+
+    @staticmethod
+    def _emit(trace: Trace, event: TelegramObject, total_ms: float, slow: bool) -> None:
+        user = None
+        if isinstance(event, Update) and event.event is not None:
+            from_user = getattr(event.event, "from_user", None)
+            user = from_user.id if from_user else None
+        record: dict[str, Any] = {
+            "trace_id": trace.trace_id,
+            "update_id": getattr(event, "update_id", None),
+            "type": event.event_type if isinstance(event, Update) else type(event).__name__,
+            "user_id": user,
+            "handler": trace.handler,
+            "total_ms": round(total_ms, 2),
+            "stages_ms": {kind: round(value * 1000, 2) for kind, value in trace.totals.items()},
+        }
+        if trace.sampled:
+            record["spans"] = trace.spans
+        trace_logger.log(logging.WARNING if slow else logging.INFO, json.dumps(record, ensure_ascii=False))
+
+
+class HandlerTraceMiddleware(BaseMiddleware):
+    """Внутренний: отмечает, сколько заняли фильтры/роутинг и сам хэндлер."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        trace = CURRENT_TRACE.get()
+        if trace is None:
+            return await handler(event, data)
+        trace.handler = handler_name(data)
+        started = time.perf_counter()
+        # всё от выхода из очереди до хэндлера, кроме чтения FSM, — это фильтры и роутинг
+        routing = started - trace.dispatched - trace.totals.get("fsm", 0.0)
+        trace.add("filters", "routing", trace.dispatched, max(0.0, routing))
+        try:
+            return await handler(event, data)
+        finally:
+            trace.add("handler", trace.handler, started, time.perf_counter() - started)
+
+
+# ===== Update processing =====
+class ChatOrderedExecutor(BaseMiddleware):
+    """
+    Outer-middleware: апдейты разных чатов обрабатываются параллельно (не больше
+    UPDATE_WORKERS сразу), апдейты одного чата — строго по очереди, в порядке поступления.
+    Очередь чата занимается синхронно, до первого await, поэтому порядок совпадает
+    с порядком создания задач polling'ом. FSM-шаги админки от этого и зависят.
+    """
+
+    def __init__(self, workers: int) -> None:
+        self._workers = asyncio.Semaphore(workers)
+        # ключ чата -> future последнего принятого апдейта этого чата
+        self._tails: dict[int, asyncio.Future] = {}
+        self.in_flight = 0
+        self.running = 0
+
+    @staticmethod
+    def chat_key(event: TelegramObject) -> Optional[int]:
+        if not isinstance(event, Update):
+            return None
+        context = UserContextMiddleware.resolve_event_context(event)
+        if context.chat is not None:
+            return context.chat.id
+        return context.user.id if context.user is not None else None
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        key = self.chat_key(event)
+        previous = self._tails.get(key) if key is not None else None
+        done = asyncio.get_running_loop().create_future()
+        if key is not None:
+            self._tails[key] = done
+        self.in_flight += 1
+        started = time.perf_counter()
+        try:
+            if previous is not None:
+                # shield: отмена ожидающего не должна отменять future предыдущего апдейта
+                await asyncio.shield(previous)
+            async with self._workers:
+                dispatched = time.perf_counter()
+                record_span("queue", "wait", started, dispatched - started)
+                trace = CURRENT_TRACE.get()
+                if trace is not None:
+                    trace.dispatched = dispatched
+                self.running += 1
+                try:
+                    return await handler(event, data)
+                finally:
+                    self.running -= 1
+        finally:
+            self.in_flight -= 1
+            if previous is not None and not previous.done():
+                # отменили, пока ждали очереди: следующий в чате всё равно ждёт предыдущего
+                previous.add_done_callback(lambda _: done.done() or done.set_result(None))
+            elif not done.done():
+                done.set_result(None)
+            if key is not None and self._tails.get(key) is done:
+                del self._tails[key]
+
+    def stats(self) -> dict[str, int]:
+        return {"in_flight": self.in_flight, "running": self.running, "chats": len(self._tails)}
+
+    async def drain(self, timeout: float) -> int:
+        """Дождаться принятых апдейтов; вернуть, сколько не успело завершиться."""
+        # задачи, созданные polling'ом перед остановкой, занимают очередь на первом шаге
+        await asyncio.sleep(0)
+        deadline = time.monotonic() + timeout
+        while self.in_flight and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        return self.in_flight
+
+
+UPDATE_EXECUTOR = ChatOrderedExecutor(UPDATE_WORKERS)
+
+
+def install_outer_first(dispatcher: Dispatcher, *middlewares: BaseMiddleware) -> None:
+    # встроенные outer-middleware (ошибки, user context, FSM) переставляем внутрь наших
+    builtin = list(dispatcher.update.outer_middleware)
+    for middleware in builtin:
+        dispatcher.update.outer_middleware.unregister(middleware)
+    for middleware in (*middlewares, *builtin):
+        dispatcher.update.outer_middleware(middleware)
+
+
+# ===== DB pool =====
+# Раздел и его кнопки (по порядку) одним запросом; кнопки — JSON-массив [id, label, action_type, target, position]
+NODE_WITH_BUTTONS_SQL = """
+SELECT n.slug, n.text,
+       coalesce(
+           (SELECT json_agg(json_build_array(b.id, b.label, b.action_type, b.target, b.position)
+                            ORDER BY b.position, b.id)
+            FROM buttons b
+            WHERE b.node_id = n.id),
+           '[]'
+       ) AS buttons
+FROM nodes n
+WHERE n.slug = $1
+"""
+
+
+async def init_connection(conn: asyncpg.Connection) -> None:
+    """
+    Хук init пула: один раз выполнить горячий запрос, чтобы он попал в кэш statement'ов
+    соединения и первый настоящий fetchrow шёл без Parse. conn.prepare() для этого не
+    годится — он готовит statement мимо кэша.
+    Через PgBouncer (transaction) prepared statements не живут — пропускаем.
+    """
+    if DB_PGBOUNCER:
+        return
+    try:
+        await conn.fetchrow(NODE_WITH_BUTTONS_SQL, "root")
+    except asyncpg.UndefinedTableError:
+        # первый запуск: схемы ещё нет, подготовится при первом запросе
+        pass
+
+
+async def create_db_pool() -> asyncpg.Pool:
+    return await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        max_inactive_connection_lifetime=DB_POOL_MAX_INACTIVE_LIFETIME,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        statement_cache_size=0 if DB_PGBOUNCER else DB_STATEMENT_CACHE_SIZE,
+        timeout=DB_CONNECT_TIMEOUT,
+        init=init_connection,
+    )
+
+
+async def warmup_pool() -> None:
+    """Сразу поднять и проверить min_size соединений, чтобы первые клики не ждали коннекта."""
+    async def ping() -> None:
+        async with db_acquire() as conn:
+            await conn.fetchval("SELECT 1")
+
+    await asyncio.gather(*(ping() for _ in range(DB_POOL_MIN_SIZE)))
+
+
+async def connect_direct() -> asyncpg.Connection:
+    """Отдельное соединение вне POOL (LISTEN, курсор рассылки)."""
+    return await asyncpg.connect(DATABASE_DIRECT_URL, command_timeout=None)
+
+
+class PoolStats:
+    def __init__(self) -> None:
+        self.waiting = 0
+        self.in_use = 0
+        self.acquired = 0
+        self.timeouts = 0
+        self.wait_max = 0.0
+        self.wait_recent: deque[float] = deque(maxlen=1000)
+
+    def observe(self, waited: float) -> None:
+        self.acquired += 1
+        self.wait_recent.append(waited)
+        self.wait_max = max(self.wait_max, waited)
+
+    def stats(self) -> dict[str, float]:
+        recent = sorted(self.wait_recent)
+        return {
+            "size": POOL.get_size() if POOL is not None else 0,
+            "idle": POOL.get_idle_size() if POOL is not None else 0,
+            "max_size": DB_POOL_MAX_SIZE,
+            "in_use": self.in_use,
+            "waiting": self.waiting,
+            "acquired": self.acquired,
+            "timeouts": self.timeouts,
+            "wait_avg": sum(recent) / len(recent) if recent else 0.0,
+            "wait_p95": recent[int(len(recent) * 0.95)] if recent else 0.0,
+            "wait_max": self.wait_max,
+        }
+
+
+POOL_STATS = PoolStats()
+
+
+class DbUnavailable(RuntimeError):
+    """БД сейчас не используем: автомат разомкнут или пула нет (меню из файла)."""
+
+
+# Сбои, которые означают «БД недоступна», а не ошибку в запросе
+DB_OUTAGE_ERRORS: tuple[type[BaseException], ...] = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.InterfaceError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.CannotConnectNowError,
+    asyncpg.AdminShutdownError,
+    asyncpg.CrashShutdownError,
+    asyncpg.TooManyConnectionsError,
+)
+
+
+class CircuitBreaker:
+    """
+    После threshold сбоев подряд размыкается: запросы сразу получают DbUnavailable,
+    а не висят по таймауту каждый. Раз в cooldown пропускает один пробный запрос.
+    """
+
+    def __init__(self, threshold: int = DB_BREAKER_FAILURES, cooldown: float = DB_BREAKER_COOLDOWN) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trips = 0
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at < self.cooldown:
+            return False
+        # пробный запрос; следующий — не раньше чем через cooldown
+        self.opened_at = now
+        return True
+
+    def success(self) -> None:
+        if self.opened_at is not None:
+            logger.warning("Database is reachable again, circuit closed")
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.opened_at is not None:
+            self.opened_at = time.monotonic()
+        elif self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+            self.trips += 1
+            logger.error("Database circuit opened after %s failures", self.failures)
+
+
+DB_CIRCUIT = CircuitBreaker()
+
+
+@asynccontextmanager
+async def db_acquire() -> AsyncIterator[asyncpg.Connection]:
+    """
+    POOL.acquire() с таймаутом и учётом ожидания — видно, когда пул упирается в max_size.
+    Таймауты и обрывы считаются автоматом DB_CIRCUIT.
+    """
+    if POOL is None:
+        raise DbUnavailable("database is not connected")
+    if not DB_CIRCUIT.allow():
+        raise DbUnavailable("database circuit is open")
+    started = time.monotonic()
+    POOL_STATS.waiting += 1
+    try:
+        conn = await POOL.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        POOL_STATS.timeouts += 1
+        DB_CIRCUIT.failure()
+        raise
+    except DB_OUTAGE_ERRORS:
+        DB_CIRCUIT.failure()
+        raise
+    finally:
+        POOL_STATS.waiting -= 1
+    waited = time.monotonic() - started
+    POOL_STATS.observe(waited)
+    DB_ACQUIRE_SECONDS.observe(waited)
+    if waited > DB_SLOW_ACQUIRE:
+        logger.warning("Waited %.3fs for a DB connection (in use %s/%s)", waited, POOL_STATS.in_use, DB_POOL_MAX_SIZE)
+    POOL_STATS.in_use += 1
+    try:
+        yield conn
+    except DbUnavailable:
+        raise
+    except DB_OUTAGE_ERRORS:
+        DB_CIRCUIT.failure()
+        raise
+    else:
+        DB_CIRCUIT.success()
+    finally:
+        POOL_STATS.in_use -= 1
+        await POOL.release(conn)
+
+
+# ===== FSM storage =====
+class PgStorage(BaseStorage):
+    """
+    FSM в таблице fsm_states через общий POOL: переживает рестарт и видна всем репликам.
+    Ключ — (bot, chat, user); thread_id/destiny не используются (только личные чаты).
+
+    root_menu_click спрашивает состояние на каждое сообщение, а оно почти у всех пустое,
+    поэтому «состояния нет» кэшируется в памяти на FSM_NEGATIVE_TTL секунд.
+    Кэш у каждой реплики свой и между ними не сбрасывается, поэтому для тех, у кого
+    состояние бывает (uncached_users — админ), он не ведётся: шаг, начатый на одной
+    реплике, должен сразу увидеть и другая.
+    """
+
+    def __init__(
+        self,
+        ttl: float = FSM_TTL,
+        negative_ttl: float = FSM_NEGATIVE_TTL,
+        uncached_users: Iterable[int] = (OWNER_ID,),
+    ) -> None:
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.uncached_users = frozenset(uncached_users)
+        self._empty: dict[tuple[int, int, int], float] = {}
+
+    @staticmethod
+    def _key(key: StorageKey) -> tuple[int, int, int]:
+        return key.bot_id, key.chat_id, key.user_id
+
+    def _is_empty(self, k: tuple[int, int, int]) -> bool:
+        expires = self._empty.get(k)
+        return expires is not None and expires > time.monotonic()
+
+    def _mark_empty(self, k: tuple[int, int, int]) -> None:
+        if k[2] in self.uncached_users:
+            return
+        now = time.monotonic()
+        if len(self._empty) > 50_000:
+            self._empty = {key: exp for key, exp in self._empty.items() if exp > now}
+        self._empty[k] = now + self.negative_ttl
+
+    async def _fetch(self, k: tuple[int, int, int]) -> Optional[tuple[Optional[str], dict[str, Any]]]:
+        if self._is_empty(k):
+            return None
+        try:
+            with observe_db("fsm_get", kind="fsm"):
+                async with db_acquire() as conn:
+                    row = await conn.fetchrow(
+                        """
+                        SELECT state, data FROM fsm_states
+                        WHERE bot_id=$1 AND chat_id=$2 AND user_id=$3 AND expires_at > now()
+                        """,
+                        *k,
+                    )
+        except (DbUnavailable, *DB_OUTAGE_ERRORS):
+            # БД лежит — считаем, что состояния нет: навигация по меню не должна падать
+            return None
+        data = json.loads(row["data"]) if row else {}
+        if row is None or (row["state"] is None and not data):
+            self._mark_empty(k)
+            return None
+        return row["state"], data
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = await self._fetch(self._key(key))
+        return row[0] if row else None
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        row = await self._fetch(self._key(key))
+        return row[1] if row else {}
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k = self._key(key)
+        value = state.state if isinstance(state, State) else state
+        async with db_acquire() as conn:
+            if value is None:
+                # сброс: строку не создаём, только обнуляем существующую
+                data = await conn.fetchval(
+                    "UPDATE fsm_states SET state=NULL WHERE bot_id=$1 AND chat_id=$2 AND user_id=$3 RETURNING data",
+                    *k,
+                )
+                if data is None or not json.loads(data):
+                    self._mark_empty(k)
+                return
+            await conn.execute(
+                """
+                INSERT INTO fsm_states (bot_id, chat_id, user_id, state, expires_at)
+                VALUES ($1, $2, $3, $4, now() + make_interval(secs => $5))
+                ON CONFLICT (bot_id, chat_id, user_id) DO UPDATE
+                SET state = EXCLUDED.state,
+                    data = CASE WHEN fsm_states.expires_at > now() THEN fsm_states.data ELSE '{}'::jsonb END,
+                    expires_at = EXCLUDED.expires_at
+                """,
+                *k,
+                value,
+                self.ttl,
+            )
+        self._empty.pop(k, None)
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        k = self._key(key)
+        async with db_acquire() as conn:
+            if not data:
+                row = await conn.fetchrow(
+                    "UPDATE fsm_states SET data='{}' WHERE bot_id=$1 AND chat_id=$2 AND user_id=$3 RETURNING state",
+                    *k,
+                )
+                if row is None or row["state"] is None:
+                    self._mark_empty(k)
+                return
+            await conn.execute(
+                """
+                INSERT INTO fsm_states (bot_id, chat_id, user_id, data, expires_at)
+                VALUES ($1, $2, $3, $4::jsonb, now() + make_interval(secs => $5))
+                ON CONFLICT (bot_id, chat_id, user_id) DO UPDATE
+                SET state = CASE WHEN fsm_states.expires_at > now() THEN fsm_states.state END,
+                    data = EXCLUDED.data,
+                    expires_at = EXCLUDED.expires_at
+                """,
+                *k,
+                json.dumps(dict(data)),
+                self.ttl,
+            )
+        self._empty.pop(k, None)
+
+    async def update_data(self, key: StorageKey, data: Mapping[str, Any]) -> dict[str, Any]:
+        # одним запросом вместо get_data + set_data
+        k = self._key(key)
+        async with db_acquire() as conn:
+            merged = await conn.fetchval(
+                """
+                INSERT INTO fsm_states (bot_id, chat_id, user_id, data, expires_at)
+                VALUES ($1, $2, $3, $4::jsonb, now() + make_interval(secs => $5))
+                ON CONFLICT (bot_id, chat_id, user_id) DO UPDATE
+                SET state = CASE WHEN fsm_states.expires_at > now() THEN fsm_states.state END,
+                    data = CASE WHEN fsm_states.expires_at > now() THEN fsm_states.data ELSE '{}'::jsonb END
+                           || EXCLUDED.data,
+                    expires_at = EXCLUDED.expires_at
+                RETURNING data
+                """,
+                *k,
+                json.dumps(dict(data)),
+                self.ttl,
+            )
+        self._empty.pop(k, None)
+        return json.loads(merged)
+
+    async def sweep(self) -> None:
+        async with db_acquire() as conn:
+            await conn.execute(
+                "DELETE FROM fsm_states WHERE expires_at <= now() OR (state IS NULL AND data = '{}'::jsonb)"
+            )
+
+    async def run_sweeper(self, interval: float = 3600) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sweep()
+            except Exception:
+                logger.exception("Failed to sweep FSM states")
+
+    async def close(self) -> None:
+        # POOL закрывает main()
+        pass
+
+
+FSM_STORAGE = PgStorage()
+dp = Dispatcher(storage=FSM_STORAGE)
+# трасса снаружи, чтобы в неё попало и ожидание своей очереди
+install_outer_first(dp, TracingMiddleware(), UPDATE_EXECUTOR)
+dp.message.middleware(HandlerTraceMiddleware())
+dp.callback_query.middleware(HandlerTraceMiddleware())
+dp.update.outer_middleware(UpdateMetricsMiddleware())
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+
+# Канал LISTEN/NOTIFY, по которому реплики узнают о правках меню
+MENU_CHANNEL = "menu_changed"
 
 
 # ===== FSM flows (админка кнопками) =====
@@ -95,6 +1047,16 @@ class DeleteButtonFlow(StatesGroup):
     button_id = State()
 
 
+class BroadcastFlow(StatesGroup):
+    text = State()
+    confirm = State()
+
+
+class ImportMenuFlow(StatesGroup):
+    file = State()
+    confirm = State()
+
+
 @dataclass(frozen=True)
 class Node:
     slug: str
@@ -110,6 +1072,33 @@ class Button:
     position: int
 
 
+@dataclass(frozen=True)
+class MenuSnapshot:
+    """
+    Снимок всего дерева меню (nodes + buttons) в памяти.
+    Не мутируется: после правок в админке собирается новый и подменяется целиком.
+    """
+
+    version: int
+    nodes: dict[str, Node]
+    buttons: dict[str, tuple[Button, ...]]
+    # точная подпись корневой кнопки -> target; запасной индекс по normalize_label(label)
+    root_targets: dict[str, str]
+    root_targets_normalized: dict[str, str]
+    # готовые клавиатуры: собираются один раз на снимок, а не на каждый клик
+    keyboards: dict[str, Optional[InlineKeyboardMarkup]]
+    root_reply_kb: ReplyKeyboardMarkup
+    # id(markup) -> (markup, JSON) для MenuSession
+    markup_json: dict[int, tuple[object, str]]
+    # id кнопки -> (slug раздела, в котором она стоит; кнопка)
+    button_index: dict[int, tuple[str, Button]]
+
+
+# Текущий снимок меню; None — ещё не загружен (тогда читаем из БД напрямую)
+MENU: Optional[MenuSnapshot] = None
+MENU_LOCK = asyncio.Lock()
+
+
 def is_owner(user_id: int) -> bool:
     return OWNER_ID != 0 and user_id == OWNER_ID
 
@@ -123,57 +1112,355 @@ def is_http_url(value: str) -> bool:
     return v.startswith("https://") or v.startswith("http://")
 
 
+# ===== Структура меню по умолчанию =====
+DEFAULT_NODES: list[tuple[str, str]] = [
+    ("root", DEFAULT_ROOT_TEXT),
+    ("courses", "Выберите раздел 👇"),
+    (
+        "pre_courses",
+        "Все курсы в нашей линейке предзаписанные и с постоянными апдейтами под изменения в Озон.\n\n"
+        "Не надо ждать потоков, курс идет по принципу «Купи и смотри». Доступ к нему и ко всем его "
+        "изменениям остается навсегда.\n\n"
+        "Вся линейка курсов задумана, как постоянно обновляемая База Знаний, с помощью которых вы "
+        "сможете обучать новых сотрудников и постоянно актуализировать свои знания. Доступ ко всем "
+        "обновлениям купленного курса БЕСПЛАТНЫЙ.",
+    ),
+    (
+        "beginner_course",
+        "«Грамотный старт на Озон» — для селлеров и менеджеров, которые делают первые шаги в Озон "
+        "и хотят начать уверенно разбираться во всех основных вещах, необходимых для ведения прибыльного бизнеса.",
+    ),
+    ("advanced_courses", "Продвинутый уровень: выберите курс 👇"),
+    (
+        "pro_logistics",
+        "Курс PRO логистику для тех, кто хочет снизить СВД в своем кабинете, понимать сколько товара "
+        "грузить в каждый кластер и понять, как не переплачивать за логистику.",
+    ),
+    (
+        "pro_ads",
+        "Курс PRO рекламу — для тех, кто хочет оптимизировать свои рекламные расходы, научиться выстраивать "
+        "рекламные стратегии и понимать, какими инструментами продвижения пользоваться для разных типов товаров "
+        "и в различных ситуациях.",
+    ),
+    (
+        "pro_analytics",
+        "Курс PRO Аналитику — для тех, кто хочет изучить все значимые нюансы и все инструменты, которые необходимы для анализа.",
+    ),
+    (
+        "pro_finance",
+        "Курс «PRO Финансы» — для тех, кто хочет научиться считать юнит-план и юнит-факт, ROI и маржинальность. "
+        "Разбираться в финансовых отчетах Озона, иметь представление о кредитных инструментах.",
+    ),
+    ("all_about_ozon", "Все 4 блока курсов PRO логистику, PRO рекламу, PRO аналитику, PRO финансы в одном со скидкой 20%."),
+    ("special_courses", "Спецкурсы и инструменты: выберите курс 👇"),
+    (
+        "pro_design",
+        "Курс «PRO Дизайн» — для тех, кто хочет понять принципы продающей инфографики, уберечь себя от ошибок "
+        "в дизайне карточек товара, которые ведут к снижению CTR, научиться выстраивать взаимоотношения с дизайнерами "
+        "и «считывать» их квалификацию.",
+    ),
+    (
+        "sxr_ai",
+        "Курс по нейросетям от SXR Studio для тех, кто смотрит в будущее и хочет научиться генерировать нейро-контент "
+        "для своих карточек товара.",
+    ),
+    (
+        "new_courses",
+        "Здесь будут появляться анонсы новых курсов и специальных форматов обучения.\n\n"
+        "Мы регулярно работаем над тем, чтобы обучение было еще полезнее и эффективнее. Возможно, это будут обновленные "
+        "программы или новые проекты.\n\n"
+        "Хотите быть в курсе всех новинок первыми?\n"
+        f"👉 Подпишитесь на наш канал: {CHANNEL_URL}\n\n"
+        "А пока все наши основные курсы для старта и уверенного роста уже ждут вас в 📚 Предзаписанные курсы.",
+    ),
+    (
+        "webinars",
+        "Поздравляю! Вам открыт доступ к вебинарам по Яндекс маркету.\n\n"
+        "Что вы получите внутри:\n"
+        "1. Запись 3-х дней вебинаров по ЯМ, в которых разобраны все аспекты работы с площадкой.\n"
+        "2. Ссылка на чат единомышленников.\n\n"
+        "Кстати, подписывайтесь на мой канал «Синий рассвет» — там куча полезной информации по Озон и про бизнес на маркетплейсах в целом.",
+    ),
+    (
+        "help",
+        "Чтобы подобрать курс, который решит именно вашу задачу, напишите напрямую @BlueRise_support. "
+        "Опишите ваш опыт и цель — и вы получите персональную рекомендацию.",
+    ),
+    (
+        "support",
+        "По любым техническим вопросам (доступ к курсам, проблемы с оплатой) напишите напрямую @BlueRise_support. "
+        "Опишите проблему как можно подробнее — это поможет решить её быстрее.",
+    ),
+    (
+        "calculator",
+        "Поздравляю! Вам открыт доступ к обновленному калькулятору.\n\n"
+        "Что вы получите внутри:\n"
+        "1. Калькулятор с FBS и новой логистикой.\n"
+        "2. Подробное видеообъяснение к калькулятору: как пользоваться, что ввести, на что смотреть.\n\n"
+        "Кстати, подписывайтесь на мой канал «Синий рассвет». Там куча полезной информации по Озон и про бизнес на маркетплейсах в целом.",
+    ),
+    (
+        "partnership",
+        "Привет! 👋\n\n"
+        "Этот раздел — для обсуждения профессионального партнёрства.\n\n"
+        "Чтобы предложить свою идею, напишите напрямую @BlueRise_support в Telegram. "
+        "В первом сообщении кратко опишите суть предложения — это поможет начать диалог максимально предметно.\n\n"
+        "Жду вашего сообщения! 🤝",
+    ),
+    (
+        "consult",
+        "Индивидуальный разбор вашего кейса.\n\n"
+        "Для записи заполните, пожалуйста, форму. Это поможет подготовиться к нашей встрече.",
+    ),
+]
+
+
+def course_buttons(details_url: str, course_title: str, back: str) -> list[tuple[str, str, str]]:
+    return [
+        ("Узнать подробности и купить курс", "url", details_url),
+        (BILL_BUTTON_LABEL, "url", tg_link(SUPPORT_CONTACT, bill_prefill(course_title))),
+        (PAYLINK_BUTTON_LABEL, "url", tg_link(SUPPORT_CONTACT, paylink_prefill(course_title))),
+        ("⬅️ Назад", "node", back),
+    ]
+
+
+# slug -> кнопки (label, action_type, target); position = порядковый номер в списке
+DEFAULT_BUTTONS: dict[str, list[tuple[str, str, str]]] = {
+    "root": [
+        ("Наши курсы", "node", "courses"),
+        ("Калькулятор OZON/ЯМ", "node", "calculator"),
+        ("Сотрудничество", "node", "partnership"),
+        ("Личная консультация", "node", "consult"),
+    ],
+    "courses": [
+        ("📚 Предзаписанные курсы", "node", "pre_courses"),
+        ("🆕 Новинки и потоки", "node", "new_courses"),
+        ("🔶 Бесплатные вебинары по ЯМ", "node", "webinars"),
+        ("❓ Помощь с выбором курса", "node", "help"),
+        ("🛠️ Техническая поддержка", "node", "support"),
+        ("⬅️ Назад", "node", "root"),
+    ],
+    "pre_courses": [
+        ("🚀 Ozon: Начальный уровень", "node", "beginner_course"),
+        ("⚡ Ozon: Продвинутый уровень", "node", "advanced_courses"),
+        ("🛠️ Спецкурсы и инструменты", "node", "special_courses"),
+        ("⬅️ Назад", "node", "courses"),
+    ],
+    "beginner_course": course_buttons("https://bluerise.getcourse.ru/GSO_VC", "Грамотный старт на Озон", "pre_courses"),
+    "advanced_courses": [
+        ("PRO логистику", "node", "pro_logistics"),
+        ("PRO рекламу", "node", "pro_ads"),
+        ("PRO Аналитику", "node", "pro_analytics"),
+        ("PRO Финансы", "node", "pro_finance"),
+        ("Всё про Озон", "node", "all_about_ozon"),
+        ("⬅️ Назад", "node", "pre_courses"),
+    ],
+    "pro_logistics": course_buttons("https://bluerise.getcourse.ru/PRO_logistics", "PRO логистику", "advanced_courses"),
+    "pro_ads": course_buttons("https://bluerise.getcourse.ru/PRO_Reklamu", "PRO рекламу", "advanced_courses"),
+    "pro_analytics": course_buttons("https://bluerise.getcourse.ru/PRO_Analytics", "PRO Аналитику", "advanced_courses"),
+    "pro_finance": course_buttons("https://bluerise.getcourse.ru/PRO_Finance", "PRO Финансы", "advanced_courses"),
+    "all_about_ozon": course_buttons("https://bluerise.getcourse.ru/all_about_ozon", "Всё про Озон", "advanced_courses"),
+    "special_courses": [
+        ("PRO Дизайн", "node", "pro_design"),
+        ("Нейросети от SXR Studio", "node", "sxr_ai"),
+        ("⬅️ Назад", "node", "pre_courses"),
+    ],
+    "pro_design": course_buttons("https://bluerise.getcourse.ru/PRO_design", "PRO Дизайн", "special_courses"),
+    "sxr_ai": course_buttons("https://bluerise.getcourse.ru/SXR_AI", "Нейросети от SXR Studio", "special_courses"),
+    "new_courses": [
+        ("📚 Предзаписанные курсы", "node", "pre_courses"),
+        ("Подписаться на канал", "url", CHANNEL_URL),
+        ("⬅️ Назад", "node", "courses"),
+    ],
+    "webinars": [
+        ("Вебинар тут", "url", "https://bluerise.getcourse.ru/teach/control/stream/view/id/934642226"),
+        ("Подписаться на канал", "url", CHANNEL_URL),
+        ("⬅️ Назад", "node", "courses"),
+    ],
+    "help": [
+        ("Написать в поддержку", "url", tg_link(SUPPORT_CONTACT, "Добрый день. Помогите с выбором курса.")),
+        ("⬅️ Назад", "node", "courses"),
+    ],
+    "support": [
+        (
+            "Написать в поддержку",
+            "url",
+            tg_link(SUPPORT_CONTACT, "Добрый день. Возникла техническая проблема: (опишите, пожалуйста)."),
+        ),
+        ("⬅️ Назад", "node", "courses"),
+    ],
+    "calculator": [
+        (
+            "Калькулятор здесь",
+            "url",
+            "https://docs.google.com/spreadsheets/d/1e4AVf3dDueEoPxQHeKOVFHgSpbcLvnbGnn6_I6ApRwg/edit?gid=246238448#gid=246238448",
+        ),
+        ("Подписаться на канал", "url", CHANNEL_URL),
+        ("⬅️ Назад", "node", "root"),
+    ],
+    "partnership": [
+        ("Написать в Telegram", "url", tg_link(SUPPORT_CONTACT, "Здравствуйте! Хочу обсудить сотрудничество.")),
+        ("⬅️ Назад", "node", "root"),
+    ],
+    "consult": [
+        ("📅 ЗАПОЛНИТЬ ЗАЯВКУ", "url", CONSULT_FORM_URL),
+        ("⬅️ Назад", "node", "root"),
+    ],
+}
+
+
 # ===== DB init / migrations =====
 async def init_db() -> None:
     """
-    - создаём таблицы
-    - чистим дубли
-    - создаём UNIQUE индекс (node_id, label)
-    - сидим структуру (upsert)
-    - миграции/нормализации (без падения на UNIQUE)
+    Применить недостающие миграции схемы/данных.
+    Обычный старт — один SELECT max(version) и больше ничего.
     """
-    assert POOL is not None
-    async with POOL.acquire() as conn:
-        await conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS nodes (
-                id SERIAL PRIMARY KEY,
-                slug TEXT UNIQUE NOT NULL,
-                text TEXT NOT NULL
-            );
-            """
-        )
-        await conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS buttons (
-                id SERIAL PRIMARY KEY,
-                node_id INTEGER NOT NULL REFERENCES nodes(id) ON DELETE CASCADE,
-                label TEXT NOT NULL,
-                action_type TEXT NOT NULL,
-                target TEXT NOT NULL,
-                position INTEGER NOT NULL DEFAULT 0
-            );
-            """
-        )
+    async with db_acquire() as conn:
+        await run_migrations(conn)
 
-        await dedupe_buttons(conn)
 
-        await conn.execute(
-            """
-            CREATE UNIQUE INDEX IF NOT EXISTS ux_buttons_node_label
-            ON buttons (node_id, label);
-            """
-        )
+async def migrate_base_schema(conn: asyncpg.Connection) -> None:
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS nodes (
+            id SERIAL PRIMARY KEY,
+            slug TEXT UNIQUE NOT NULL,
+            text TEXT NOT NULL
+        );
+        """
+    )
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS buttons (
+            id SERIAL PRIMARY KEY,
+            node_id INTEGER NOT NULL REFERENCES nodes(id) ON DELETE CASCADE,
+            label TEXT NOT NULL,
+            action_type TEXT NOT NULL,
+            target TEXT NOT NULL,
+            position INTEGER NOT NULL DEFAULT 0
+        );
+        """
+    )
+
 
-        root_id = await ensure_node(conn, "root", DEFAULT_ROOT_TEXT)
-        await seed_default_nodes(conn, root_id)
+async def migrate_buttons_unique_label(conn: asyncpg.Connection) -> None:
+    await dedupe_buttons(conn)
+    await conn.execute(
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS ux_buttons_node_label
+        ON buttons (node_id, label);
+        """
+    )
 
-        await migrate_support_contacts(conn)
-        await migrate_text_typos(conn)
-        await fix_root_placeholder_if_needed(conn)
 
-        await normalize_buttons(conn)
-        await dedupe_buttons(conn)
+async def migrate_normalize_buttons(conn: asyncpg.Connection) -> None:
+    await normalize_buttons(conn)
+    await dedupe_buttons(conn)
+
+
+async def migrate_menu_version(conn: asyncpg.Connection) -> None:
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS menu_version (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            version BIGINT NOT NULL DEFAULT 0
+        );
+        INSERT INTO menu_version (id, version) VALUES (TRUE, 0) ON CONFLICT DO NOTHING;
+        """
+    )
+
+
+async def migrate_fsm_states(conn: asyncpg.Connection) -> None:
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            bot_id BIGINT NOT NULL,
+            chat_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            state TEXT,
+            data JSONB NOT NULL DEFAULT '{}'::jsonb,
+            expires_at TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (bot_id, chat_id, user_id)
+        );
+        CREATE INDEX IF NOT EXISTS ix_fsm_states_expires_at ON fsm_states (expires_at);
+        """
+    )
+
+
+async def migrate_users_and_broadcasts(conn: asyncpg.Connection) -> None:
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            first_name TEXT,
+            username TEXT,
+            first_seen TIMESTAMPTZ NOT NULL DEFAULT now(),
+            last_seen TIMESTAMPTZ NOT NULL DEFAULT now(),
+            blocked BOOLEAN NOT NULL DEFAULT FALSE
+        );
+        """
+    )
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id SERIAL PRIMARY KEY,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id BIGINT NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            finished_at TIMESTAMPTZ
+        );
+        """
+    )
+
+
+async def migrate_deeplink_stats(conn: asyncpg.Connection) -> None:
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS deeplink_stats (
+            payload TEXT PRIMARY KEY,
+            slug TEXT NOT NULL,
+            starts BIGINT NOT NULL DEFAULT 0,
+            first_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            last_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        """
+    )
+
+
+async def migrate_nav_events(conn: asyncpg.Connection) -> None:
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS nav_events (
+            at TIMESTAMPTZ NOT NULL,
+            user_id BIGINT,
+            from_slug TEXT,
+            target TEXT NOT NULL,
+            button_id INTEGER,
+            source TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS ix_nav_events_at ON nav_events (at);
+        """
+    )
+
+
+async def migrate_buttons_render_index(conn: asyncpg.Connection) -> None:
+    # индекс под WHERE node_id = ... ORDER BY position, id
+    await conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS ix_buttons_node_position
+        ON buttons (node_id, position, id);
+        """
+    )
+
+
+async def migrate_buttons_render_index_slim(conn: asyncpg.Connection) -> None:
+    # первая версия индекса несла INCLUDE (label, action_type, target): длинный URL не влезал
+    # в запись btree (~2.7 КБ), и правка кнопки падала с ProgramLimitExceededError
+    await conn.execute("DROP INDEX IF EXISTS ix_buttons_node_position")
+    await migrate_buttons_render_index(conn)
 
 
 async def fix_root_placeholder_if_needed(conn: asyncpg.Connection) -> None:
@@ -185,21 +1472,6 @@ async def fix_root_placeholder_if_needed(conn: asyncpg.Connection) -> None:
         await conn.execute("UPDATE nodes SET text=$1 WHERE slug='root'", DEFAULT_ROOT_TEXT)
 
 
-async def ensure_node(conn: asyncpg.Connection, slug: str, text: str) -> int:
-    node_id = await conn.fetchval(
-        "INSERT INTO nodes (slug, text) VALUES ($1, $2) "
-        "ON CONFLICT (slug) DO NOTHING RETURNING id",
-        slug,
-        text,
-    )
-    if node_id:
-        return node_id
-    existing = await conn.fetchval("SELECT id FROM nodes WHERE slug=$1", slug)
-    if not existing:
-        raise RuntimeError(f"Failed to create or fetch node: {slug}")
-    return existing
-
-
 async def ensure_button(
     conn: asyncpg.Connection,
     node_id: int,
@@ -225,248 +1497,67 @@ async def ensure_button(
     )
 
 
-async def seed_default_nodes(
-    conn: asyncpg.Connection,
-    root_id: int,
-    *,
-    replace_existing: bool = False,
-) -> None:
-    nodes = [
-        ("courses", "Выберите раздел 👇"),
-        (
-            "pre_courses",
-            "Все курсы в нашей линейке предзаписанные и с постоянными апдейтами под изменения в Озон.\n\n"
-            "Не надо ждать потоков, курс идет по принципу «Купи и смотри». Доступ к нему и ко всем его "
-            "изменениям остается навсегда.\n\n"
-            "Вся линейка курсов задумана, как постоянно обновляемая База Знаний, с помощью которых вы "
-            "сможете обучать новых сотрудников и постоянно актуализировать свои знания. Доступ ко всем "
-            "обновлениям купленного курса БЕСПЛАТНЫЙ.",
-        ),
-        (
-            "beginner_course",
-            "«Грамотный старт на Озон» — для селлеров и менеджеров, которые делают первые шаги в Озон "
-            "и хотят начать уверенно разбираться во всех основных вещах, необходимых для ведения прибыльного бизнеса.",
-        ),
-        ("advanced_courses", "Продвинутый уровень: выберите курс 👇"),
-        (
-            "pro_logistics",
-            "Курс PRO логистику для тех, кто хочет снизить СВД в своем кабинете, понимать сколько товара "
-            "грузить в каждый кластер и понять, как не переплачивать за логистику.",
-        ),
-        (
-            "pro_ads",
-            "Курс PRO рекламу — для тех, кто хочет оптимизировать свои рекламные расходы, научиться выстраивать "
-            "рекламные стратегии и понимать, какими инструментами продвижения пользоваться для разных типов товаров "
-            "и в различных ситуациях.",
-        ),
-        (
-            "pro_analytics",
-            "Курс PRO Аналитику — для тех, кто хочет изучить все значимые нюансы и все инструменты, которые необходимы для анализа.",
-        ),
-        (
-            "pro_finance",
-            "Курс «PRO Финансы» — для тех, кто хочет научиться считать юнит-план и юнит-факт, ROI и маржинальность. "
-            "Разбираться в финансовых отчетах Озона, иметь представление о кредитных инструментах.",
-        ),
-        ("all_about_ozon", "Все 4 блока курсов PRO логистику, PRO рекламу, PRO аналитику, PRO финансы в одном со скидкой 20%."),
-        ("special_courses", "Спецкурсы и инструменты: выберите курс 👇"),
-        (
-            "pro_design",
-            "Курс «PRO Дизайн» — для тех, кто хочет понять принципы продающей инфографики, уберечь себя от ошибок "
-            "в дизайне карточек товара, которые ведут к снижению CTR, научиться выстраивать взаимоотношения с дизайнерами "
-            "и «считывать» их квалификацию.",
-        ),
-        (
-            "sxr_ai",
-            "Курс по нейросетям от SXR Studio для тех, кто смотрит в будущее и хочет научиться генерировать нейро-контент "
-            "для своих карточек товара.",
-        ),
-        (
-            "new_courses",
-            "Здесь будут появляться анонсы новых курсов и специальных форматов обучения.\n\n"
-            "Мы регулярно работаем над тем, чтобы обучение было еще полезнее и эффективнее. Возможно, это будут обновленные "
-            "программы или новые проекты.\n\n"
-            "Хотите быть в курсе всех новинок первыми?\n"
-            f"👉 Подпишитесь на наш канал: {CHANNEL_URL}\n\n"
-            "А пока все наши основные курсы для старта и уверенного роста уже ждут вас в 📚 Предзаписанные курсы.",
-        ),
-        (
-            "webinars",
-            "Поздравляю! Вам открыт доступ к вебинарам по Яндекс маркету.\n\n"
-            "Что вы получите внутри:\n"
-            "1. Запись 3-х дней вебинаров по ЯМ, в которых разобраны все аспекты работы с площадкой.\n"
-            "2. Ссылка на чат единомышленников.\n\n"
-            "Кстати, подписывайтесь на мой канал «Синий рассвет» — там куча полезной информации по Озон и про бизнес на маркетплейсах в целом.",
-        ),
-        (
-            "help",
-            "Чтобы подобрать курс, который решит именно вашу задачу, напишите напрямую @BlueRise_support. "
-            "Опишите ваш опыт и цель — и вы получите персональную рекомендацию.",
-        ),
-        (
-            "support",
-            "По любым техническим вопросам (доступ к курсам, проблемы с оплатой) напишите напрямую @BlueRise_support. "
-            "Опишите проблему как можно подробнее — это поможет решить её быстрее.",
-        ),
-        (
-            "calculator",
-            "Поздравляю! Вам открыт доступ к обновленному калькулятору.\n\n"
-            "Что вы получите внутри:\n"
-            "1. Калькулятор с FBS и новой логистикой.\n"
-            "2. Подробное видеообъяснение к калькулятору: как пользоваться, что ввести, на что смотреть.\n\n"
-            "Кстати, подписывайтесь на мой канал «Синий рассвет». Там куча полезной информации по Озон и про бизнес на маркетплейсах в целом.",
-        ),
-        (
-            "partnership",
-            "Привет! 👋\n\n"
-            "Этот раздел — для обсуждения профессионального партнёрства.\n\n"
-            "Чтобы предложить свою идею, напишите напрямую @BlueRise_support в Telegram. "
-            "В первом сообщении кратко опишите суть предложения — это поможет начать диалог максимально предметно.\n\n"
-            "Жду вашего сообщения! 🤝",
-        ),
-        (
-            "consult",
-            "Индивидуальный разбор вашего кейса.\n\n"
-            "Для записи заполните, пожалуйста, форму. Это поможет подготовиться к нашей встрече.",
-        ),
-    ]
+async def seed_default_nodes(conn: asyncpg.Connection, *, replace_existing: bool = False) -> None:
+    """
+    Залить DEFAULT_NODES / DEFAULT_BUTTONS одной транзакцией: по одному
+    запросу на nodes и buttons (unnest), независимо от размера меню.
+    replace_existing — перезаписать тексты и пересобрать кнопки с нуля.
+    """
+    slugs = [slug for slug, _ in DEFAULT_NODES]
+    texts = [text for _, text in DEFAULT_NODES]
 
-    node_ids = {"root": root_id}
-    for slug, text in nodes:
-        node_id = await ensure_node(conn, slug, text)
-        node_ids[slug] = node_id
+    async with conn.transaction():
         if replace_existing:
-            await conn.execute("UPDATE nodes SET text=$1 WHERE slug=$2", text, slug)
-
-    if replace_existing:
-        await conn.execute("DELETE FROM buttons WHERE node_id = ANY($1::int[])", list(node_ids.values()))
-        await conn.execute("UPDATE nodes SET text=$1 WHERE slug='root'", DEFAULT_ROOT_TEXT)
-
-    # ROOT
-    await ensure_button(conn, root_id, "Наши курсы", "node", "courses", 1)
-    await ensure_button(conn, root_id, "Калькулятор OZON/ЯМ", "node", "calculator", 2)
-    await ensure_button(conn, root_id, "Сотрудничество", "node", "partnership", 3)
-    await ensure_button(conn, root_id, "Личная консультация", "node", "consult", 4)
-
-    # COURSES
-    await ensure_button(conn, node_ids["courses"], "📚 Предзаписанные курсы", "node", "pre_courses", 1)
-    await ensure_button(conn, node_ids["courses"], "🆕 Новинки и потоки", "node", "new_courses", 2)
-    await ensure_button(conn, node_ids["courses"], "🔶 Бесплатные вебинары по ЯМ", "node", "webinars", 3)
-    await ensure_button(conn, node_ids["courses"], "❓ Помощь с выбором курса", "node", "help", 4)
-    await ensure_button(conn, node_ids["courses"], "🛠️ Техническая поддержка", "node", "support", 5)
-    await ensure_button(conn, node_ids["courses"], "⬅️ Назад", "node", "root", 6)
-
-    # PRE COURSES
-    await ensure_button(conn, node_ids["pre_courses"], "🚀 Ozon: Начальный уровень", "node", "beginner_course", 1)
-    await ensure_button(conn, node_ids["pre_courses"], "⚡ Ozon: Продвинутый уровень", "node", "advanced_courses", 2)
-    await ensure_button(conn, node_ids["pre_courses"], "🛠️ Спецкурсы и инструменты", "node", "special_courses", 3)
-    await ensure_button(conn, node_ids["pre_courses"], "⬅️ Назад", "node", "courses", 4)
-
-    # BEGINNER
-    course_title = "Грамотный старт на Озон"
-    await ensure_button(conn, node_ids["beginner_course"], "Узнать подробности и купить курс", "url", "https://bluerise.getcourse.ru/GSO_VC", 1)
-    await ensure_button(conn, node_ids["beginner_course"], BILL_BUTTON_LABEL, "url", tg_link(SUPPORT_CONTACT, bill_prefill(course_title)), 2)
-    await ensure_button(conn, node_ids["beginner_course"], PAYLINK_BUTTON_LABEL, "url", tg_link(SUPPORT_CONTACT, paylink_prefill(course_title)), 3)
-    await ensure_button(conn, node_ids["beginner_course"], "⬅️ Назад", "node", "pre_courses", 4)
-
-    # ADVANCED COURSES
-    await ensure_button(conn, node_ids["advanced_courses"], "PRO логистику", "node", "pro_logistics", 1)
-    await ensure_button(conn, node_ids["advanced_courses"], "PRO рекламу", "node", "pro_ads", 2)
-    await ensure_button(conn, node_ids["advanced_courses"], "PRO Аналитику", "node", "pro_analytics", 3)
-    await ensure_button(conn, node_ids["advanced_courses"], "PRO Финансы", "node", "pro_finance", 4)
-    await ensure_button(conn, node_ids["advanced_courses"], "Всё про Озон", "node", "all_about_ozon", 5)
-    await ensure_button(conn, node_ids["advanced_courses"], "⬅️ Назад", "node", "pre_courses", 6)
-
-    # PRO LOGISTICS
-    course_title = "PRO логистику"
-    await ensure_button(conn, node_ids["pro_logistics"], "Узнать подробности и купить курс", "url", "https://bluerise.getcourse.ru/PRO_logistics", 1)
-    await ensure_button(conn, node_ids["pro_logistics"], BILL_BUTTON_LABEL, "url", tg_link(SUPPORT_CONTACT, bill_prefill(course_title)), 2)
-    await ensure_button(conn, node_ids["pro_logistics"], PAYLINK_BUTTON_LABEL, "url", tg_link(SUPPORT_CONTACT, paylink_prefill(course_title)), 3)
-    await ensure_button(conn, node_ids["pro_logistics"], "⬅️ Назад", "node", "advanced_courses", 4)
-
-    # PRO ADS
-    course_title = "PRO рекламу"
-    await ensure_button(conn, node_ids["pro_ads"], "Узнать подробности и купить курс", "url", "https://bluerise.getcourse.ru/PRO_Reklamu", 1)
-    await ensure_button(conn, node_ids["pro_ads"], BILL_BUTTON_LABEL, "url", tg_link(SUPPORT_CONTACT, bill_prefill(course_title)), 2)
-    await ensure_button(conn, node_ids["pro_ads"], PAYLINK_BUTTON_LABEL, "url", tg_link(SUPPORT_CONTACT, paylink_prefill(course_title)), 3)
-    await ensure_button(conn, node_ids["pro_ads"], "⬅️ Назад", "node", "advanced_courses", 4)
-
-    # PRO ANALYTICS
-    course_title = "PRO Аналитику"
-    await ensure_button(conn, node_ids["pro_analytics"], "Узнать подробности и купить курс", "url", "https://bluerise.getcourse.ru/PRO_Analytics", 1)
-    await ensure_button(conn, node_ids["pro_analytics"], BILL_BUTTON_LABEL, "url", tg_link(SUPPORT_CONTACT, bill_prefill(course_title)), 2)
-    await ensure_button(conn, node_ids["pro_analytics"], PAYLINK_BUTTON_LABEL, "url", tg_link(SUPPORT_CONTACT, paylink_prefill(course_title)), 3)
-    await ensure_button(conn, node_ids["pro_analytics"], "⬅️ Назад", "node", "advanced_courses", 4)
-
-    # PRO FINANCE
-    course_title = "PRO Финансы"
-    await ensure_button(conn, node_ids["pro_finance"], "Узнать подробности и купить курс", "url", "https://bluerise.getcourse.ru/PRO_Finance", 1)
-    await ensure_button(conn, node_ids["pro_finance"], BILL_BUTTON_LABEL, "url", tg_link(SUPPORT_CONTACT, bill_prefill(course_title)), 2)
-    await ensure_button(conn, node_ids["pro_finance"], PAYLINK_BUTTON_LABEL, "url", tg_link(SUPPORT_CONTACT, paylink_prefill(course_title)), 3)
-    await ensure_button(conn, node_ids["pro_finance"], "⬅️ Назад", "node", "advanced_courses", 4)
-
-    # ALL ABOUT OZON
-    course_title = "Всё про Озон"
-    await ensure_button(conn, node_ids["all_about_ozon"], "Узнать подробности и купить курс", "url", "https://bluerise.getcourse.ru/all_about_ozon", 1)
-    await ensure_button(conn, node_ids["all_about_ozon"], BILL_BUTTON_LABEL, "url", tg_link(SUPPORT_CONTACT, bill_prefill(course_title)), 2)
-    await ensure_button(conn, node_ids["all_about_ozon"], PAYLINK_BUTTON_LABEL, "url", tg_link(SUPPORT_CONTACT, paylink_prefill(course_title)), 3)
-    await ensure_button(conn, node_ids["all_about_ozon"], "⬅️ Назад", "node", "advanced_courses", 4)
-
-    # SPECIAL COURSES
-    await ensure_button(conn, node_ids["special_courses"], "PRO Дизайн", "node", "pro_design", 1)
-    await ensure_button(conn, node_ids["special_courses"], "Нейросети от SXR Studio", "node", "sxr_ai", 2)
-    await ensure_button(conn, node_ids["special_courses"], "⬅️ Назад", "node", "pre_courses", 3)
-
-    # PRO DESIGN
-    course_title = "PRO Дизайн"
-    await ensure_button(conn, node_ids["pro_design"], "Узнать подробности и купить курс", "url", "https://bluerise.getcourse.ru/PRO_design", 1)
-    await ensure_button(conn, node_ids["pro_design"], BILL_BUTTON_LABEL, "url", tg_link(SUPPORT_CONTACT, bill_prefill(course_title)), 2)
-    await ensure_button(conn, node_ids["pro_design"], PAYLINK_BUTTON_LABEL, "url", tg_link(SUPPORT_CONTACT, paylink_prefill(course_title)), 3)
-    await ensure_button(conn, node_ids["pro_design"], "⬅️ Назад", "node", "special_courses", 4)
-
-    # SXR AI
-    course_title = "Нейросети от SXR Studio"
-    await ensure_button(conn, node_ids["sxr_ai"], "Узнать подробности и купить курс", "url", "https://bluerise.getcourse.ru/SXR_AI", 1)
-    await ensure_button(conn, node_ids["sxr_ai"], BILL_BUTTON_LABEL, "url", tg_link(SUPPORT_CONTACT, bill_prefill(course_title)), 2)
-    await ensure_button(conn, node_ids["sxr_ai"], PAYLINK_BUTTON_LABEL, "url", tg_link(SUPPORT_CONTACT, paylink_prefill(course_title)), 3)
-    await ensure_button(conn, node_ids["sxr_ai"], "⬅️ Назад", "node", "special_courses", 4)
-
-    # NEW COURSES
-    await ensure_button(conn, node_ids["new_courses"], "📚 Предзаписанные курсы", "node", "pre_courses", 1)
-    await ensure_button(conn, node_ids["new_courses"], "Подписаться на канал", "url", CHANNEL_URL, 2)
-    await ensure_button(conn, node_ids["new_courses"], "⬅️ Назад", "node", "courses", 3)
-
-    # WEBINARS
-    await ensure_button(conn, node_ids["webinars"], "Вебинар тут", "url", "https://bluerise.getcourse.ru/teach/control/stream/view/id/934642226", 1)
-    await ensure_button(conn, node_ids["webinars"], "Подписаться на канал", "url", CHANNEL_URL, 2)
-    await ensure_button(conn, node_ids["webinars"], "⬅️ Назад", "node", "courses", 3)
-
-    # HELP / SUPPORT
-    await ensure_button(conn, node_ids["help"], "Написать в поддержку", "url", tg_link(SUPPORT_CONTACT, "Добрый день. Помогите с выбором курса."), 1)
-    await ensure_button(conn, node_ids["help"], "⬅️ Назад", "node", "courses", 2)
-
-    await ensure_button(conn, node_ids["support"], "Написать в поддержку", "url", tg_link(SUPPORT_CONTACT, "Добрый день. Возникла техническая проблема: (опишите, пожалуйста)."), 1)
-    await ensure_button(conn, node_ids["support"], "⬅️ Назад", "node", "courses", 2)
-
-    # CALCULATOR
-    await ensure_button(
-        conn,
-        node_ids["calculator"],
-        "Калькулятор здесь",
-        "url",
-        "https://docs.google.com/spreadsheets/d/1e4AVf3dDueEoPxQHeKOVFHgSpbcLvnbGnn6_I6ApRwg/edit?gid=246238448#gid=246238448",
-        1,
-    )
-    await ensure_button(conn, node_ids["calculator"], "Подписаться на канал", "url", CHANNEL_URL, 2)
-    await ensure_button(conn, node_ids["calculator"], "⬅️ Назад", "node", "root", 3)
+            rows = await conn.fetch(
+                """
+                INSERT INTO nodes (slug, text)
+                SELECT * FROM unnest($1::text[], $2::text[])
+                ON CONFLICT (slug) DO UPDATE SET text = EXCLUDED.text
+                RETURNING id, slug
+                """,
+                slugs,
+                texts,
+            )
+        else:
+            rows = await conn.fetch(
+                """
+                WITH ins AS (
+                    INSERT INTO nodes (slug, text)
+                    SELECT * FROM unnest($1::text[], $2::text[])
+                    ON CONFLICT (slug) DO NOTHING
+                    RETURNING id, slug
+                )
+                SELECT id, slug FROM ins
+                UNION ALL
+                SELECT id, slug FROM nodes WHERE slug = ANY($1::text[])
+                """,
+                slugs,
+                texts,
+            )
+        node_ids = {row["slug"]: row["id"] for row in rows}
+        missing = set(slugs) - set(node_ids)
+        if missing:
+            raise RuntimeError(f"Failed to create or fetch nodes: {sorted(missing)}")
 
-    # PARTNERSHIP
-    await ensure_button(conn, node_ids["partnership"], "Написать в Telegram", "url", tg_link(SUPPORT_CONTACT, "Здравствуйте! Хочу обсудить сотрудничество."), 1)
-    await ensure_button(conn, node_ids["partnership"], "⬅️ Назад", "node", "root", 2)
+        if replace_existing:
+            await conn.execute("DELETE FROM buttons WHERE node_id = ANY($1::int[])", list(node_ids.values()))
 
-    # CONSULT
-    await ensure_button(conn, node_ids["consult"], "📅 ЗАПОЛНИТЬ ЗАЯВКУ", "url", CONSULT_FORM_URL, 1)
-    await ensure_button(conn, node_ids["consult"], "⬅️ Назад", "node", "root", 2)
+        columns: tuple[list, ...] = ([], [], [], [], [])
+        for slug, buttons in DEFAULT_BUTTONS.items():
+            for position, (label, action_type, target) in enumerate(buttons, start=1):
+                for column, value in zip(columns, (node_ids[slug], label, action_type, target, position)):
+                    column.append(value)
+        await conn.execute(
+            """
+            INSERT INTO buttons (node_id, label, action_type, target, position)
+            SELECT * FROM unnest($1::int[], $2::text[], $3::text[], $4::text[], $5::int[])
+            ON CONFLICT (node_id, label) DO UPDATE
+            SET action_type = EXCLUDED.action_type,
+                target = EXCLUDED.target,
+                position = EXCLUDED.position
+            """,
+            *columns,
+        )
 
 
 async def migrate_support_contacts(conn: asyncpg.Connection) -> None:
@@ -586,64 +1677,1183 @@ async def normalize_buttons(conn: asyncpg.Connection) -> None:
     )
 
 
-async def dedupe_buttons(conn: asyncpg.Connection) -> None:
-    await conn.execute(
-        """
-        DELETE FROM buttons
-        WHERE id IN (
-            SELECT id
-            FROM (
-                SELECT id,
-                       row_number() OVER (
-                           PARTITION BY node_id, label
-                           ORDER BY id
-                       ) AS rn
-                FROM buttons
-            ) t
-            WHERE t.rn > 1
-        )
-        """
-    )
+async def dedupe_buttons(conn: asyncpg.Connection) -> None:
+    await conn.execute(
+        """
+        DELETE FROM buttons
+        WHERE id IN (
+            SELECT id
+            FROM (
+                SELECT id,
+                       row_number() OVER (
+                           PARTITION BY node_id, label
+                           ORDER BY id
+                       ) AS rn
+                FROM buttons
+            ) t
+            WHERE t.rn > 1
+        )
+        """
+    )
+
+
+# Миграции применяются один раз и по порядку; уже выпущенные не менять — только добавлять новые.
+# Все шаги идемпотентны: на базах, созданных до schema_migrations, они просто ничего не меняют.
+# Новые кнопки/разделы в DEFAULT_NODES/DEFAULT_BUTTONS на существующие базы сами не попадут:
+# для них нужна новая миграция (или «♻️ Восстановить»).
+MIGRATIONS: list[tuple[int, str, Callable[[asyncpg.Connection], Awaitable[None]]]] = [
+    (1, "base_schema", migrate_base_schema),
+    (2, "buttons_unique_label", migrate_buttons_unique_label),
+    (3, "seed_default_menu", seed_default_nodes),
+    (4, "support_contacts", migrate_support_contacts),
+    (5, "text_typos", migrate_text_typos),
+    (6, "root_placeholder", fix_root_placeholder_if_needed),
+    (7, "normalize_buttons", migrate_normalize_buttons),
+    (8, "menu_version", migrate_menu_version),
+    (9, "users_and_broadcasts", migrate_users_and_broadcasts),
+    (10, "fsm_states", migrate_fsm_states),
+    (11, "deeplink_stats", migrate_deeplink_stats),
+    (12, "nav_events", migrate_nav_events),
+    (13, "buttons_render_index", migrate_buttons_render_index),
+    (14, "buttons_render_index_slim", migrate_buttons_render_index_slim),
+]
+
+# Ключ advisory lock, под которым реплики по очереди применяют миграции
+MIGRATIONS_LOCK_KEY = 7_000
+
+
+async def schema_version(conn: asyncpg.Connection) -> int:
+    try:
+        return await conn.fetchval("SELECT coalesce(max(version), 0) FROM schema_migrations")
+    except asyncpg.UndefinedTableError:
+        return 0
+
+
+async def run_migrations(conn: asyncpg.Connection) -> None:
+    latest = MIGRATIONS[-1][0]
+    if await schema_version(conn) >= latest:
+        return
+
+    # всё в одной транзакции под xact-локом: вторая реплика дождётся первой
+    # и увидит уже применённые версии; работает и через PgBouncer
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", MIGRATIONS_LOCK_KEY)
+        await conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            );
+            """
+        )
+        applied = {row["version"] for row in await conn.fetch("SELECT version FROM schema_migrations")}
+        for version, name, migrate in MIGRATIONS:
+            if version in applied:
+                continue
+            await migrate(conn)
+            await conn.execute("INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", version, name)
+            logger.info("Applied migration %s_%s", version, name)
+
+
+# ===== Menu cache =====
+async def load_menu(conn: asyncpg.Connection) -> MenuSnapshot:
+    # одна транзакция, чтобы nodes и buttons были согласованы между собой
+    async with conn.transaction(isolation="repeatable_read", readonly=True):
+        version = await conn.fetchval("SELECT version FROM menu_version")
+        node_rows = await conn.fetch("SELECT id, slug, text FROM nodes")
+        button_rows = await conn.fetch(
+            """
+            SELECT id, node_id, label, action_type, target, position
+            FROM buttons
+            ORDER BY position ASC, id ASC
+            """
+        )
+    return build_snapshot(version or 0, node_rows, button_rows)
+
+
+async def load_menu_nodes(
+    conn: asyncpg.Connection,
+    base: MenuSnapshot,
+    slugs: set[str],
+    version: int,
+) -> MenuSnapshot:
+    """Перечитать только изменившиеся разделы поверх текущего снимка."""
+    async with conn.transaction(isolation="repeatable_read", readonly=True):
+        node_rows = await conn.fetch(
+            "SELECT id, slug, text FROM nodes WHERE slug = ANY($1::text[])",
+            list(slugs),
+        )
+        button_rows = await conn.fetch(
+            """
+            SELECT b.id, b.node_id, b.label, b.action_type, b.target, b.position
+            FROM buttons b
+            JOIN nodes n ON n.id = b.node_id
+            WHERE n.slug = ANY($1::text[])
+            ORDER BY b.position ASC, b.id ASC
+            """,
+            list(slugs),
+        )
+    fresh = build_snapshot(version, node_rows, button_rows)
+
+    nodes = {slug: node for slug, node in base.nodes.items() if slug not in slugs}
+    nodes.update(fresh.nodes)
+    buttons = {slug: items for slug, items in base.buttons.items() if slug not in slugs}
+    buttons.update(fresh.buttons)
+    return make_snapshot(version, nodes, buttons, base=base, changed=slugs)
+
+
+def build_snapshot(
+    version: int,
+    node_rows: Iterable[asyncpg.Record],
+    button_rows: Iterable[asyncpg.Record],
+) -> MenuSnapshot:
+    slug_by_id: dict[int, str] = {}
+    nodes: dict[str, Node] = {}
+    for row in node_rows:
+        slug_by_id[row["id"]] = row["slug"]
+        nodes[row["slug"]] = Node(slug=row["slug"], text=row["text"])
+
+    grouped: dict[str, list[Button]] = {slug: [] for slug in nodes}
+    for row in button_rows:
+        slug = slug_by_id.get(row["node_id"])
+        if slug is None:
+            continue
+        grouped[slug].append(
+            Button(
+                id=row["id"],
+                label=row["label"],
+                action_type=row["action_type"],
+                target=row["target"],
+                position=row["position"],
+            )
+        )
+
+    buttons = {slug: tuple(items) for slug, items in grouped.items()}
+    return make_snapshot(version, nodes, buttons)
+
+
+def make_snapshot(
+    version: int,
+    nodes: dict[str, Node],
+    buttons: dict[str, tuple[Button, ...]],
+    *,
+    base: Optional[MenuSnapshot] = None,
+    changed: Iterable[str] = (),
+) -> MenuSnapshot:
+    """Достроить производные структуры; клавиатуры неизменённых разделов берём из base."""
+    changed = set(changed)
+    keyboards: dict[str, Optional[InlineKeyboardMarkup]] = {}
+    for slug in nodes:
+        if base is not None and slug not in changed and slug in base.keyboards:
+            keyboards[slug] = base.keyboards[slug]
+        else:
+            keyboards[slug] = build_kb(buttons.get(slug, ()))
+
+    root_buttons = buttons.get("root", ())
+    if base is not None and "root" not in changed:
+        root_reply_kb = base.root_reply_kb
+    else:
+        root_reply_kb = build_root_reply_kb(root_buttons)
+
+    markup_json: dict[int, tuple[object, str]] = {}
+    for markup in [root_reply_kb, *keyboards.values()]:
+        if markup is not None:
+            markup_json[id(markup)] = (markup, json.dumps(markup.model_dump(exclude_none=True)))
+
+    root_targets, root_targets_normalized = build_root_index(root_buttons)
+    return MenuSnapshot(
+        version=version,
+        nodes=nodes,
+        buttons=buttons,
+        root_targets=root_targets,
+        root_targets_normalized=root_targets_normalized,
+        keyboards=keyboards,
+        root_reply_kb=root_reply_kb,
+        markup_json=markup_json,
+        button_index={b.id: (slug, b) for slug, items in buttons.items() for b in items},
+    )
+
+
+# Символы, которые не считаем частью подписи: эмодзи, модификаторы, ZWJ, вариационные селекторы
+LABEL_DROP_CATEGORIES = frozenset({"So", "Sk", "Cf", "Me"})
+LABEL_DROP_CHARS = frozenset({"\ufe0e", "\ufe0f"})
+
+
+def normalize_label(text: str) -> str:
+    """«📚  Предзаписанные курсы» и «предзаписанные курсы» — одна и та же кнопка."""
+    text = unicodedata.normalize("NFC", text)
+    kept = "".join(
+        ch for ch in text if ch not in LABEL_DROP_CHARS and unicodedata.category(ch) not in LABEL_DROP_CATEGORIES
+    )
+    return " ".join(kept.split()).casefold()
+
+
+def build_root_index(root_buttons: Iterable[Button]) -> tuple[dict[str, str], dict[str, str]]:
+    """
+    Точные подписи и нормализованные. Точная подпись находит кнопку всегда — даже
+    «📚», у которой после нормализации ничего не остаётся, и даже если её нормализованный
+    вид совпал с другой кнопкой. При совпадении побеждает кнопка выше в меню.
+    """
+    exact: dict[str, str] = {}
+    normalized: dict[str, str] = {}
+    for btn in root_buttons:
+        if btn.label in exact:
+            logger.warning("Root buttons share the label %r, only the first one is reachable", btn.label)
+        exact.setdefault(btn.label, btn.target)
+        key = normalize_label(btn.label)
+        if not key:
+            continue
+        if key in normalized and normalized[key] != btn.target:
+            logger.warning("Root button %r normalizes to %r like an earlier one, matched by exact text only", btn.label, key)
+        normalized.setdefault(key, btn.target)
+    return exact, normalized
+
+
+def node_kb(slug: str, buttons: Iterable[Button]) -> Optional[InlineKeyboardMarkup]:
+    menu = MENU
+    if menu is not None and slug in menu.keyboards:
+        return menu.keyboards[slug]
+    return build_kb(buttons)
+
+
+def root_kb(buttons: Iterable[Button]) -> ReplyKeyboardMarkup:
+    menu = MENU
+    if menu is not None:
+        return menu.root_reply_kb
+    return build_root_reply_kb(buttons)
+
+
+class MenuSession(AiohttpSession):
+    """
+    Клавиатуры из снимка меню уже сериализованы в JSON — подставляем готовую
+    строку вместо model_dump + json.dumps на каждую отправку.
+    """
+
+    def build_form_data(self, bot: Bot, method: TelegramMethod) -> FormData:
+        markup = getattr(method, "reply_markup", None)
+        menu = MENU
+        cached = menu.markup_json.get(id(markup)) if menu is not None and markup is not None else None
+        if cached is None or cached[0] is not markup:
+            return super().build_form_data(bot=bot, method=method)
+
+        form = FormData(quote_fields=False)
+        files: dict = {}
+        for key, value in method.model_dump(warnings=False, exclude={"reply_markup"}).items():
+            value = self.prepare_value(value, bot=bot, files=files)
+            if not value:
+                continue
+            form.add_field(key, value)
+        form.add_field("reply_markup", cached[1])
+        for key, value in files.items():
+            form.add_field(key, value.read(bot), filename=value.filename or key)
+        return form
+
+
+async def reload_menu(slugs: Optional[Iterable[str]] = None, version: Optional[int] = None) -> None:
+    """
+    Перечитать дерево из БД и атомарно подменить снимок.
+    slugs + version — точечная перезагрузка после правки с этим номером версии;
+    если версии идут не подряд (пропустили уведомление), перечитываем всё.
+    """
+    global MENU
+    async with MENU_LOCK:
+        current = MENU
+        if current is not None and version is not None and version <= current.version:
+            return
+        partial = (
+            current is not None
+            and slugs is not None
+            and version is not None
+            and version == current.version + 1
+        )
+        with observe_db("menu_reload_partial" if partial else "menu_reload"):
+            async with db_acquire() as conn:
+                if partial:
+                    snapshot = await load_menu_nodes(conn, current, set(slugs), version)
+                else:
+                    snapshot = await load_menu(conn)
+        MENU = snapshot
+        if MENU_SNAPSHOT_PATH:
+            try:
+                await asyncio.to_thread(save_snapshot_file, MENU_SNAPSHOT_PATH, snapshot)
+            except OSError:
+                logger.exception("Failed to save menu snapshot to %s", MENU_SNAPSHOT_PATH)
+
+
+async def publish_menu_change(conn: asyncpg.Connection, slugs: Optional[Iterable[str]] = None) -> int:
+    """
+    Поднять menu_version и разослать NOTIFY. Вызывать в той же транзакции,
+    что и сама правка: уведомление уйдёт только после COMMIT.
+    slugs=None — изменилось всё дерево.
+    """
+    version = await conn.fetchval("UPDATE menu_version SET version = version + 1 RETURNING version")
+    payload = {"version": version, "slugs": sorted(set(slugs)) if slugs is not None else None}
+    await conn.execute("SELECT pg_notify($1, $2)", MENU_CHANNEL, json.dumps(payload))
+    return version
+
+
+async def handle_menu_notification(payload: str) -> None:
+    try:
+        data = json.loads(payload)
+        await reload_menu(data.get("slugs"), int(data["version"]))
+    except Exception:
+        logger.exception("Failed to apply menu notification: %s", payload)
+
+
+async def run_menu_listener() -> None:
+    """
+    Отдельное (не из POOL) соединение под LISTEN. При обрыве переподключаемся
+    и перечитываем меню целиком — уведомления за время простоя потеряны.
+    """
+    tasks: set[asyncio.Task] = set()
+
+    def on_notify(_conn: asyncpg.Connection, _pid: int, _channel: str, payload: str) -> None:
+        task = asyncio.create_task(handle_menu_notification(payload))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    while True:
+        try:
+            conn = await connect_direct()
+        except (asyncpg.PostgresError, *DB_OUTAGE_ERRORS):
+            logger.warning("Menu listener: cannot connect, retrying in 5s")
+            await asyncio.sleep(5)
+            continue
+
+        closed = asyncio.Event()
+        conn.add_termination_listener(lambda _conn: closed.set())
+        try:
+            await conn.add_listener(MENU_CHANNEL, on_notify)
+            await reload_menu()
+            await closed.wait()
+            logger.warning("Menu listener: connection lost, reconnecting")
+        except (DbUnavailable, asyncpg.PostgresError, *DB_OUTAGE_ERRORS):
+            logger.exception("Menu listener failed, reconnecting")
+            await asyncio.sleep(5)
+        finally:
+            if not conn.is_closed():
+                conn.terminate()
+
+
+# ===== Menu snapshot file =====
+SNAPSHOT_FORMAT = 1
+# меню в режиме «только чтение»: поднято из MENU_SNAPSHOT_PATH, БД недоступна
+MENU_READ_ONLY = False
+
+
+def snapshot_to_dict(menu: MenuSnapshot) -> dict[str, Any]:
+    """Компактный вид: кнопки — [label, action_type, target, id], порядок = position."""
+    return {
+        "format": SNAPSHOT_FORMAT,
+        "version": menu.version,
+        "exported_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "nodes": [
+            {
+                "slug": slug,
+                "text": node.text,
+                "buttons": [[b.label, b.action_type, b.target, b.id] for b in menu.buttons.get(slug, ())],
+            }
+            for slug, node in sorted(menu.nodes.items(), key=lambda item: (item[0] != "root", item[0]))
+        ],
+    }
+
+
+def snapshot_from_dict(data: Any) -> MenuSnapshot:
+    """Проверить структуру и собрать MenuSnapshot. Ошибки — ValueError с понятным текстом."""
+    if not isinstance(data, dict) or data.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError(f"неизвестный формат снимка (ожидается format={SNAPSHOT_FORMAT})")
+    items = data.get("nodes")
+    if not isinstance(items, list) or not items:
+        raise ValueError("в снимке нет разделов")
+
+    nodes: dict[str, Node] = {}
+    buttons: dict[str, tuple[Button, ...]] = {}
+    button_id = 0
+    for item in items:
+        slug = item.get("slug") if isinstance(item, dict) else None
+        text = item.get("text") if isinstance(item, dict) else None
+        if not isinstance(slug, str) or not slug.strip() or not isinstance(text, str):
+            raise ValueError(f"раздел без slug или текста: {item!r:.80}")
+        if slug in nodes:
+            raise ValueError(f"раздел {slug} повторяется")
+        nodes[slug] = Node(slug=slug, text=text)
+
+        parsed: list[Button] = []
+        labels: set[str] = set()
+        for position, raw in enumerate(item.get("buttons") or [], start=1):
+            if (
+                not isinstance(raw, list)
+                or len(raw) not in (3, 4)
+                or not all(isinstance(v, str) for v in raw[:3])
+                or (len(raw) == 4 and not isinstance(raw[3], int))
+            ):
+                raise ValueError(f"{slug}: кнопка должна быть [label, action_type, target] или [..., id]")
+            label, action_type, target = raw[:3]
+            if action_type not in ("node", "url"):
+                raise ValueError(f"{slug}: у кнопки «{label}» action_type {action_type!r}")
+            if label in labels:
+                raise ValueError(f"{slug}: кнопка «{label}» повторяется")
+            labels.add(label)
+            # id из БД сохраняем (callback_data, /go/<id> в уже отправленных сообщениях);
+            # без него — отрицательный, чтобы не совпасть с настоящими
+            button_id -= 1
+            parsed.append(
+                Button(
+                    id=raw[3] if len(raw) == 4 else button_id,
+                    label=label,
+                    action_type=action_type,
+                    target=target,
+                    position=position,
+                )
+            )
+        buttons[slug] = tuple(parsed)
+
+    if "root" not in nodes:
+        raise ValueError("нет раздела root")
+    version = data.get("version")
+    return make_snapshot(version if isinstance(version, int) else 0, nodes, buttons)
+
+
+def load_snapshot_file(path: str) -> MenuSnapshot:
+    with open(path, encoding="utf-8") as f:
+        return snapshot_from_dict(json.load(f))
+
+
+def save_snapshot_file(path: str, menu: MenuSnapshot) -> None:
+    # через временный файл: при падении посреди записи старый снимок останется целым
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(snapshot_to_dict(menu), f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def dangling_targets(menu: MenuSnapshot) -> list[str]:
+    return [
+        f"{slug}: «{b.label}» → {b.target}"
+        for slug, items in menu.buttons.items()
+        for b in items
+        if b.action_type == "node" and b.target not in menu.nodes
+    ]
+
+
+def diff_snapshots(old: MenuSnapshot, new: MenuSnapshot) -> list[str]:
+    lines: list[str] = []
+    for slug in sorted(new.nodes.keys() - old.nodes.keys()):
+        lines.append(f"+ раздел {slug} ({len(new.buttons.get(slug, ()))} кнопок)")
+    for slug in sorted(old.nodes.keys() - new.nodes.keys()):
+        lines.append(f"- раздел {slug}")
+    for slug in sorted(old.nodes.keys() & new.nodes.keys()):
+        if old.nodes[slug].text != new.nodes[slug].text:
+            lines.append(f"~ {slug}: текст")
+        before = {b.label: (b.action_type, b.target) for b in old.buttons.get(slug, ())}
+        after = {b.label: (b.action_type, b.target) for b in new.buttons.get(slug, ())}
+        for label in after.keys() - before.keys():
+            lines.append(f"+ {slug}: «{label}» → {after[label][1]}")
+        for label in before.keys() - after.keys():
+            lines.append(f"- {slug}: «{label}»")
+        for label in before.keys() & after.keys():
+            if before[label] != after[label]:
+                lines.append(f"~ {slug}: «{label}» → {after[label][1]}")
+        if [b.label for b in old.buttons.get(slug, ()) if b.label in after] != [
+            b.label for b in new.buttons.get(slug, ()) if b.label in before
+        ]:
+            lines.append(f"~ {slug}: порядок кнопок")
+    return lines
+
+
+async def import_menu(conn: asyncpg.Connection, menu: MenuSnapshot) -> int:
+    """
+    Заменить всё дерево содержимым снимка одной транзакцией.
+    Разделы, которых нет в снимке, удаляются (кнопки — каскадом).
+    """
+    slugs = list(menu.nodes)
+    async with conn.transaction():
+        rows = await conn.fetch(
+            """
+            INSERT INTO nodes (slug, text)
+            SELECT * FROM unnest($1::text[], $2::text[])
+            ON CONFLICT (slug) DO UPDATE SET text = EXCLUDED.text
+            RETURNING id, slug
+            """,
+            slugs,
+            [menu.nodes[slug].text for slug in slugs],
+        )
+        node_ids = {row["slug"]: row["id"] for row in rows}
+        await conn.execute("DELETE FROM nodes WHERE NOT (slug = ANY($1::text[]))", slugs)
+        await conn.execute("DELETE FROM buttons WHERE node_id = ANY($1::int[])", list(node_ids.values()))
+
+        columns: tuple[list, ...] = ([], [], [], [], [])
+        for slug, items in menu.buttons.items():
+            for b in items:
+                for column, value in zip(columns, (node_ids[slug], b.label, b.action_type, b.target, b.position)):
+                    column.append(value)
+        await conn.execute(
+            """
+            INSERT INTO buttons (node_id, label, action_type, target, position)
+            SELECT * FROM unnest($1::int[], $2::text[], $3::text[], $4::text[], $5::int[])
+            """,
+            *columns,
+        )
+        return await publish_menu_change(conn)
+
+
+class ReadOnlyGuard(BaseMiddleware):
+    """
+    Меню из файла или БД недоступна (автомат разомкнут): владельцу вместо админки —
+    объяснение, публичное меню работает из снимка в памяти.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        degraded = MENU_READ_ONLY or DB_CIRCUIT.is_open
+        if not degraded or not isinstance(event, Message) or not event.from_user:
+            return await handler(event, data)
+        if not is_owner(event.from_user.id):
+            return await handler(event, data)
+        text = event.text or ""
+        if text.startswith("/start") or (text and await find_root_target_by_label(text)):
+            return await handler(event, data)
+        await event.answer("База недоступна: меню работает из сохранённого снимка, правки и рассылки отключены.")
+        return None
+
+
+dp.message.outer_middleware(ReadOnlyGuard())
+
+
+@dp.errors(ExceptionTypeFilter(DbUnavailable, *DB_OUTAGE_ERRORS))
+async def db_outage_error(event: ErrorEvent) -> bool:
+    """Хэндлер упёрся в недоступную БД: коротко ответить, а не молчать."""
+    logger.warning("Update %s failed, database unavailable: %r", event.update.update_id, event.exception)
+    text = "Сейчас не получается это сделать, попробуйте через минуту."
+    try:
+        if event.update.callback_query is not None:
+            await event.update.callback_query.answer(text)
+        elif event.update.message is not None:
+            await event.update.message.answer(text)
+    except TelegramAPIError:
+        pass
+    return True
+
+
+# ===== Outbound rate limiting =====
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+# Приоритет исходящих запросов текущей задачи; рассылки выставляют PRIORITY_BULK
+SEND_PRIORITY: ContextVar[int] = ContextVar("send_priority", default=PRIORITY_INTERACTIVE)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, headroom: float = 0.0) -> float:
+        """Сколько ждать, пока останется свободный токен сверх headroom (не забирая его)."""
+        now = time.monotonic()
+        self._refill(now)
+        need = 1 + headroom
+        wait = 0.0 if self.tokens >= need else (need - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def reserve(self) -> float:
+        """Забрать токен (можно в долг) и вернуть, сколько ждать до его появления."""
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def block(self, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def idle(self, now: float) -> bool:
+        return now - self.updated > 60 and now >= self.blocked_until
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """
+    Очередь перед Bot API: глобальный и по-чатовый token bucket,
+    повтор после TelegramRetryAfter, интерактивные ответы вперёд рассылок.
+    Запросы без chat_id (answerCallbackQuery, getUpdates, ...) не ограничиваются.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = TG_GLOBAL_RATE,
+        chat_rate: float = TG_CHAT_RATE,
+        group_rate: float = TG_GROUP_RATE,
+        max_retries: int = TG_MAX_RETRIES,
+    ) -> None:
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.chats: dict[Union[int, str], TokenBucket] = {}
+        # метрики
+        self.waiting = {PRIORITY_INTERACTIVE: 0, PRIORITY_BULK: 0}
+        self.waiting_global = {PRIORITY_INTERACTIVE: 0, PRIORITY_BULK: 0}
+        self.sent = 0
+        self.retry_after = 0
+        self.wait_max = 0.0
+        self.wait_recent: deque[float] = deque(maxlen=1000)
+
+    def _chat_bucket(self, chat_id: Union[int, str]) -> TokenBucket:
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) > 10_000:
+                now = time.monotonic()
+                self.chats = {key: b for key, b in self.chats.items() if not b.idle(now)}
+            # группы и каналы (отрицательный id / @username) — 20 сообщений в минуту
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = TokenBucket(rate, 3)
+            self.chats[chat_id] = bucket
+        return bucket
+
+    async def _acquire(self, chat_id: Union[int, str], priority: int) -> None:
+        started = time.monotonic()
+        self.waiting[priority] += 1
+        try:
+            wait = self._chat_bucket(chat_id).reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            self.waiting_global[priority] += 1
+            try:
+                if priority == PRIORITY_BULK:
+                    # рассылка берёт глобальный лимит, только когда никто из интерактивных
+                    # не ждёт, и оставляет пятую часть ёмкости под ответы на клики
+                    headroom = self.global_bucket.capacity / 5
+                    while self.waiting_global[PRIORITY_INTERACTIVE] or self.global_bucket.delay(headroom) > 0:
+                        await asyncio.sleep(max(self.global_bucket.delay(headroom), 1 / self.global_bucket.rate))
+                wait = self.global_bucket.reserve()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            finally:
+                self.waiting_global[priority] -= 1
+        finally:
+            self.waiting[priority] -= 1
+            waited = time.monotonic() - started
+            self.wait_recent.append(waited)
+            self.wait_max = max(self.wait_max, waited)
+            SEND_WAIT_SECONDS.labels("bulk" if priority == PRIORITY_BULK else "interactive").observe(waited)
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType,
+        bot: Bot,
+        method: TelegramMethod,
+    ) -> Response:
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        priority = SEND_PRIORITY.get()
+        attempt = 0
+        while True:
+            await self._acquire(chat_id, priority)
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.retry_after += 1
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                logger.warning("Flood control for chat %s: retry in %ss", chat_id, e.retry_after)
+                self._chat_bucket(chat_id).block(e.retry_after)
+                continue
+            self.sent += 1
+            return response
+
+    def stats(self) -> dict[str, float]:
+        recent = sorted(self.wait_recent)
+        return {
+            "queue_interactive": self.waiting[PRIORITY_INTERACTIVE],
+            "queue_bulk": self.waiting[PRIORITY_BULK],
+            "sent": self.sent,
+            "retry_after": self.retry_after,
+            "wait_avg": sum(recent) / len(recent) if recent else 0.0,
+            "wait_p95": recent[int(len(recent) * 0.95)] if recent else 0.0,
+            "wait_max": self.wait_max,
+        }
+
+
+SEND_SCHEDULER = SendScheduler()
+
+
+# ===== Users / broadcast =====
+class UserRecorder:
+    """
+    Копит «кто писал боту» в памяти и пишет в users пачкой раз в USERS_FLUSH_INTERVAL
+    (или сразу, когда набралось USERS_FLUSH_BATCH), а не INSERT на каждое сообщение.
+    """
+
+    def __init__(self, interval: float = USERS_FLUSH_INTERVAL, batch: int = USERS_FLUSH_BATCH) -> None:
+        self.interval = interval
+        self.batch = batch
+        self.pending: dict[int, tuple[str, Optional[str], datetime]] = {}
+        self.wakeup = asyncio.Event()
+
+    def touch(self, user: Optional[User]) -> None:
+        if user is None or user.is_bot:
+            return
+        self.pending[user.id] = (user.first_name, user.username, datetime.now(timezone.utc))
+        if len(self.pending) >= self.batch:
+            self.wakeup.set()
+
+    async def flush(self) -> None:
+        if not self.pending or POOL is None:
+            return
+        batch, self.pending = self.pending, {}
+        ids = list(batch)
+        try:
+            async with db_acquire() as conn:
+                await conn.execute(
+                    """
+                    INSERT INTO users (user_id, first_name, username, last_seen)
+                    SELECT * FROM unnest($1::bigint[], $2::text[], $3::text[], $4::timestamptz[])
+                    ON CONFLICT (user_id) DO UPDATE
+                    SET first_name = EXCLUDED.first_name,
+                        username = EXCLUDED.username,
+                        last_seen = EXCLUDED.last_seen,
+                        blocked = FALSE
+                    """,
+                    ids,
+                    [batch[uid][0] for uid in ids],
+                    [batch[uid][1] for uid in ids],
+                    [batch[uid][2] for uid in ids],
+                )
+        except Exception:
+            # вернуть в очередь, не затирая более свежие визиты
+            for uid, item in batch.items():
+                self.pending.setdefault(uid, item)
+            raise
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush()
+            except (DbUnavailable, *DB_OUTAGE_ERRORS) as e:
+                logger.warning("Failed to flush users, database unavailable: %r", e)
+            except Exception:
+                logger.exception("Failed to flush users")
+
+
+USER_RECORDER = UserRecorder()
+
+# Deep link: /start <slug> или /start <slug>--<метка кампании>
+DEEPLINK_TAG_SEPARATOR = "--"
+# Под этим ключом (скобки не пропустит deep link — со slug не совпадёт) считаются /start
+# с неизвестным разделом или меткой, не выданной через /link:
+# иначе любой набранный руками текст стал бы отдельной строкой deeplink_stats
+DEEPLINK_OTHER = "(other)"
+
+
+def is_deeplink_payload(payload: str) -> bool:
+    """Что Telegram пропускает в ссылке t.me/<bot>?start=: A-Z, a-z, 0-9, _ и -, до 64 символов."""
+    return 0 < len(payload) <= 64 and all(ch.isascii() and (ch.isalnum() or ch in "_-") for ch in payload)
+
+
+def parse_start_payload(payload: Optional[str]) -> tuple[Optional[str], Optional[str]]:
+    """Вернуть (slug, payload для статистики); payload обрезан до лимита Telegram в 64 символа."""
+    payload = (payload or "").strip()[:64]
+    if not payload:
+        return None, None
+    slug = payload.split(DEEPLINK_TAG_SEPARATOR, 1)[0]
+    return slug or None, payload
+
+
+class DeepLinkCounter:
+    """Счётчики переходов по deep link: копятся в памяти, в deeplink_stats пишутся пачкой."""
+
+    # сколько разных payload с меткой держим до сброса, не зная, кампания ли это
+    MAX_PENDING = 1000
+
+    def __init__(self, interval: float = USERS_FLUSH_INTERVAL) -> None:
+        self.interval = interval
+        # payload -> (slug, переходов с последнего сброса); метки ещё не сверены с кампаниями
+        self.pending: dict[str, tuple[str, int]] = {}
+        # payload с меткой, выданные через /link (их строки в deeplink_stats); обновляются при сбросе
+        self.campaigns: set[str] = set()
+
+    def hit(self, payload: str, slug: Optional[str]) -> None:
+        """
+        slug — найденный раздел или None. Кампания ли метка, решает flush(), когда список
+        кампаний свежий; здесь в "other" уходит только то, что кампанией быть не может.
+        """
+        if (
+            slug is None
+            or not is_deeplink_payload(payload)
+            or (payload not in self.pending and payload not in self.campaigns and len(self.pending) >= self.MAX_PENDING)
+        ):
+            payload, slug = DEEPLINK_OTHER, ""
+        _, count = self.pending.get(payload, (slug, 0))
+        self.pending[payload] = (slug, count + 1)
+
+    async def register(self, payload: str, slug: str) -> None:
+        """Кампания из /link: только её переходы и считаются отдельно."""
+        async with db_acquire() as conn:
+            await conn.execute(
+                "INSERT INTO deeplink_stats (payload, slug) VALUES ($1, $2) ON CONFLICT (payload) DO NOTHING",
+                payload,
+                slug,
+            )
+        self.campaigns.add(payload)
+
+    async def load_campaigns(self) -> None:
+        # /link мог выполниться на другой реплике
+        async with db_acquire() as conn:
+            rows = await conn.fetch("SELECT payload FROM deeplink_stats WHERE slug <> '' AND payload <> slug")
+        self.campaigns = {row["payload"] for row in rows}
+
+    def resolve(self, batch: dict[str, tuple[str, int]]) -> dict[str, tuple[str, int]]:
+        # метки, не выданные через /link, — в "other": иначе таблица растёт от любого ввода
+        resolved: dict[str, tuple[str, int]] = {}
+        for payload, (slug, count) in batch.items():
+            if payload != slug and payload != DEEPLINK_OTHER and payload not in self.campaigns:
+                payload, slug = DEEPLINK_OTHER, ""
+            _, total = resolved.get(payload, (slug, 0))
+            resolved[payload] = (slug, total + count)
+        return resolved
+
+    async def flush(self) -> None:
+        if not self.pending or POOL is None:
+            return
+        await self.load_campaigns()
+        batch, self.pending = self.pending, {}
+        resolved = self.resolve(batch)
+        payloads = list(resolved)
+        try:
+            async with db_acquire() as conn:
+                await conn.execute(
+                    """
+                    INSERT INTO deeplink_stats (payload, slug, starts)
+                    SELECT * FROM unnest($1::text[], $2::text[], $3::bigint[])
+                    ON CONFLICT (payload) DO UPDATE
+                    SET starts = deeplink_stats.starts + EXCLUDED.starts,
+                        slug = EXCLUDED.slug,
+                        last_at = now()
+                    """,
+                    payloads,
+                    [resolved[p][0] for p in payloads],
+                    [resolved[p][1] for p in payloads],
+                )
+        except Exception:
+            # вернуть в очередь как есть (метки сверятся заново), сложив с тем, что набежало за время записи
+            for payload, (slug, count) in batch.items():
+                _, fresh = self.pending.get(payload, (slug, 0))
+                self.pending[payload] = (slug, count + fresh)
+            raise
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except (DbUnavailable, *DB_OUTAGE_ERRORS) as e:
+                logger.warning("Failed to flush deep link counters, database unavailable: %r", e)
+            except Exception:
+                logger.exception("Failed to flush deep link counters")
+
+
+DEEPLINK_COUNTER = DeepLinkCounter()
+
+
+class ClickRecorder:
+    """
+    События навигации (кто, откуда, куда, какой кнопкой) копятся в кольцевом буфере
+    и уходят в nav_events одним COPY раз в CLICKS_FLUSH_INTERVAL или при CLICKS_FLUSH_BATCH.
+    На клик — только append в deque.
+    """
+
+    COLUMNS = ("at", "user_id", "from_slug", "target", "button_id", "source")
+
+    def __init__(
+        self,
+        interval: float = CLICKS_FLUSH_INTERVAL,
+        batch: int = CLICKS_FLUSH_BATCH,
+        capacity: int = CLICKS_BUFFER_MAX,
+    ) -> None:
+        self.interval = interval
+        self.batch = batch
+        self.buffer: deque[tuple] = deque(maxlen=capacity)
+        self.wakeup = asyncio.Event()
+        self.dropped = 0
+
+    def record(
+        self,
+        user_id: Optional[int],
+        from_slug: Optional[str],
+        target: str,
+        button_id: Optional[int],
+        source: str,
+    ) -> None:
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append((datetime.now(timezone.utc), user_id, from_slug, target, button_id, source))
+        if len(self.buffer) >= self.batch:
+            self.wakeup.set()
+
+    async def flush(self) -> None:
+        if not self.buffer or POOL is None:
+            return
+        records = list(self.buffer)
+        self.buffer.clear()
+        try:
+            async with db_acquire() as conn:
+                await conn.copy_records_to_table("nav_events", records=records, columns=self.COLUMNS)
+        except Exception:
+            # вернуть в начало буфера: порядок сохраняется, при переполнении теряются самые старые
+            room = self.buffer.maxlen - len(self.buffer)
+            self.dropped += max(0, len(records) - room)
+            self.buffer.extendleft(reversed(records[-room:] if room else []))
+            raise
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush()
+            except (DbUnavailable, *DB_OUTAGE_ERRORS) as e:
+                logger.warning("Failed to flush clicks, database unavailable: %r", e)
+            except Exception:
+                logger.exception("Failed to flush clicks")
+
+
+CLICK_RECORDER = ClickRecorder()
+
+
+def course_slugs(menu: MenuSnapshot) -> list[str]:
+    """Разделы курсов — те, где есть кнопки оплаты (см. course_buttons)."""
+    return sorted(
+        slug
+        for slug, items in menu.buttons.items()
+        if any(b.label in (BILL_BUTTON_LABEL, PAYLINK_BUTTON_LABEL) for b in items)
+    )
+
+
+async def go_redirect(request: web.Request) -> web.Response:
+    """/go/<button_id>: засчитать клик по url-кнопке и отправить по её адресу."""
+    menu = MENU
+    try:
+        entry = menu.button_index.get(int(request.match_info["button_id"])) if menu is not None else None
+    except ValueError:
+        entry = None
+    if entry is None or entry[1].action_type != "url":
+        raise web.HTTPNotFound()
+    slug, button = entry
+    CLICK_RECORDER.record(None, slug, button.target, button.id, "url")
+    raise web.HTTPFound(button.target)
+
+# Ключ advisory lock: одну рассылку ведёт только одна реплика
+BROADCAST_LOCK_KEY = 7_001
+BROADCAST_TASKS: set[asyncio.Task] = set()
+
+
+def start_broadcast(bot: Bot, broadcast_id: int) -> None:
+    task = asyncio.create_task(run_broadcast(bot, broadcast_id))
+    BROADCAST_TASKS.add(task)
+    task.add_done_callback(BROADCAST_TASKS.discard)
+
+
+async def deliver_broadcast(bot: Bot, user_id: int, text: str) -> str:
+    """
+    "sent" / "blocked" / "failed". Сетевые сбои и 5xx повторяем с нарастающей паузой
+    (RetryAfter уже повторил SendScheduler), остальные ошибки API — сразу "failed".
+    """
+    for attempt in range(TG_MAX_RETRIES + 1):
+        try:
+            await bot.send_message(user_id, text)
+            return "sent"
+        except TelegramForbiddenError:
+            return "blocked"
+        except (TelegramNetworkError, TelegramServerError) as e:
+            if attempt == TG_MAX_RETRIES:
+                logger.warning("Broadcast to %s failed after %s attempts: %r", user_id, attempt + 1, e)
+                return "failed"
+            await asyncio.sleep(min(2**attempt, 30))
+        except TelegramAPIError:
+            return "failed"
+    return "failed"
+
+
+async def run_broadcast(bot: Bot, broadcast_id: int) -> None:
+    """
+    Рассылка по users: получатели идут серверным курсором по user_id
+    на отдельном соединении (не держим слот POOL), прогресс сохраняется
+    каждые BROADCAST_BATCH адресатов — после падения продолжаем с last_user_id.
+    """
+    SEND_PRIORITY.set(PRIORITY_BULK)
+    # задача создана из апдейта владельца — не дописываем тысячи спанов в его трассу
+    CURRENT_TRACE.set(None)
+    conn: Optional[asyncpg.Connection] = None
+    # прогресс; None — ещё не прочитан из broadcasts
+    last_user_id: Optional[int] = None
+    sent = failed = 0
+    blocked: list[int] = []
+
+    async def checkpoint() -> Optional[str]:
+        async with db_acquire() as pconn:
+            async with pconn.transaction():
+                if blocked:
+                    await pconn.execute("UPDATE users SET blocked = TRUE WHERE user_id = ANY($1::bigint[])", blocked)
+                status = await pconn.fetchval(
+                    "UPDATE broadcasts SET last_user_id=$2, sent=$3, failed=$4 WHERE id=$1 RETURNING status",
+                    broadcast_id,
+                    last_user_id,
+                    sent,
+                    failed,
+                )
+        blocked.clear()
+        return status
+
+    try:
+        conn = await connect_direct()
+        if not await conn.fetchval("SELECT pg_try_advisory_lock($1, $2)", BROADCAST_LOCK_KEY, broadcast_id):
+            return  # уже ведёт другая реплика
+        row = await conn.fetchrow(
+            "SELECT text, status, last_user_id, sent, failed FROM broadcasts WHERE id=$1",
+            broadcast_id,
+        )
+        if not row or row["status"] != "running":
+            return
+        text = row["text"]
+        last_user_id, sent, failed = row["last_user_id"], row["sent"], row["failed"]
+
+        async with conn.transaction(readonly=True):
+            cursor = await conn.cursor(
+                "SELECT user_id FROM users WHERE user_id > $1 AND NOT blocked ORDER BY user_id",
+                last_user_id,
+            )
+            while True:
+                records = await cursor.fetch(BROADCAST_BATCH)
+                if not records:
+                    break
+                for record in records:
+                    user_id = record["user_id"]
+                    result = await deliver_broadcast(bot, user_id, text)
+                    if result == "sent":
+                        sent += 1
+                    else:
+                        failed += 1
+                        if result == "blocked":
+                            blocked.append(user_id)
+                    last_user_id = user_id
+
+                if await checkpoint() != "running":
+                    return
+
+        async with db_acquire() as pconn:
+            await pconn.execute(
+                "UPDATE broadcasts SET status='done', finished_at=now() WHERE id=$1 AND status='running'",
+                broadcast_id,
+            )
+    except asyncio.CancelledError:
+        # остановка процесса: без сохранения те, кому уже отправили, получат рассылку повторно
+        if last_user_id is not None:
+            try:
+                await asyncio.shield(checkpoint())
+            except Exception:
+                logger.exception("Failed to save progress of broadcast %s on shutdown", broadcast_id)
+        raise
+    except Exception:
+        logger.exception("Broadcast %s failed, will resume on next start", broadcast_id)
+        if last_user_id is not None:
+            try:
+                await checkpoint()
+            except Exception:
+                logger.exception("Failed to save progress of broadcast %s", broadcast_id)
+        try:
+            await bot.send_message(
+                OWNER_ID,
+                f"Рассылка #{broadcast_id} прервалась из-за ошибки: доставлено {sent}, ошибок {failed}. "
+                "Продолжу с этого места после перезапуска.",
+            )
+        except TelegramAPIError:
+            logger.warning("Cannot notify owner about broadcast %s", broadcast_id)
+        return
+    finally:
+        if conn is not None:
+            await conn.close()
+
+    SEND_PRIORITY.set(PRIORITY_INTERACTIVE)
+    try:
+        await bot.send_message(OWNER_ID, f"Рассылка #{broadcast_id} завершена: доставлено {sent}, ошибок {failed}.")
+    except TelegramAPIError:
+        logger.warning("Cannot notify owner about broadcast %s", broadcast_id)
+
+
+async def resume_broadcasts(bot: Bot) -> None:
+    async with db_acquire() as conn:
+        rows = await conn.fetch("SELECT id FROM broadcasts WHERE status='running' ORDER BY id")
+    for row in rows:
+        start_broadcast(bot, row["id"])
 
 
 # ===== Fetch helpers =====
 async def fetch_node(slug: str) -> Optional[Node]:
-    assert POOL is not None
-    async with POOL.acquire() as conn:
-        row = await conn.fetchrow("SELECT slug, text FROM nodes WHERE slug=$1", slug)
+    if MENU is not None:
+        MENU_LOOKUPS.labels("fetch_node", "cache").inc()
+        return MENU.nodes.get(slug)
+    MENU_LOOKUPS.labels("fetch_node", "db").inc()
+    with observe_db("fetch_node"):
+        async with db_acquire() as conn:
+            row = await conn.fetchrow("SELECT slug, text FROM nodes WHERE slug=$1", slug)
     if not row:
         return None
     return Node(slug=row["slug"], text=row["text"])
 
 
-async def fetch_buttons(slug: str) -> list[Button]:
-    assert POOL is not None
-    async with POOL.acquire() as conn:
-        rows = await conn.fetch(
-            """
-            SELECT b.id, b.label, b.action_type, b.target, b.position
-            FROM buttons b
-            JOIN nodes n ON n.id = b.node_id
-            WHERE n.slug = $1
-            ORDER BY b.position ASC, b.id ASC
-            """,
-            slug,
-        )
-    return [
-        Button(
-            id=row["id"],
-            label=row["label"],
-            action_type=row["action_type"],
-            target=row["target"],
-            position=row["position"],
-        )
-        for row in rows
+async def fetch_node_with_buttons(slug: str) -> Optional[tuple[Node, list[Button]]]:
+    """fetch_node + fetch_buttons за одно обращение к БД (если снимка нет)."""
+    if MENU is not None:
+        MENU_LOOKUPS.labels("fetch_node_with_buttons", "cache").inc()
+        node = MENU.nodes.get(slug)
+        return (node, list(MENU.buttons.get(slug, ()))) if node is not None else None
+    MENU_LOOKUPS.labels("fetch_node_with_buttons", "db").inc()
+    with observe_db("fetch_node_with_buttons"):
+        async with db_acquire() as conn:
+            row = await conn.fetchrow(NODE_WITH_BUTTONS_SQL, slug)
+    if not row:
+        return None
+    buttons = [
+        Button(id=b[0], label=b[1], action_type=b[2], target=b[3], position=b[4])
+        for b in json.loads(row["buttons"])
     ]
+    return Node(slug=row["slug"], text=row["text"]), buttons
 
 
 async def find_root_target_by_label(label: str) -> Optional[str]:
-    assert POOL is not None
-    async with POOL.acquire() as conn:
+    menu = MENU
+    if menu is not None:
+        target = menu.root_targets.get(label)
+        if target is None:
+            key = normalize_label(label)
+            target = menu.root_targets_normalized.get(key) if key else None
+        return target
+    async with db_acquire() as conn:
         row = await conn.fetchrow(
             """
             SELECT b.target
@@ -662,9 +2872,11 @@ def build_kb(buttons: Iterable[Button]) -> Optional[InlineKeyboardMarkup]:
     rows: list[list[InlineKeyboardButton]] = []
     for btn in buttons:
         if btn.action_type == "url":
-            rows.append([InlineKeyboardButton(text=btn.label, url=btn.target)])
+            url = f"{WEBHOOK_BASE_URL}/go/{btn.id}" if TRACK_URL_CLICKS else btn.target
+            rows.append([InlineKeyboardButton(text=btn.label, url=url)])
         else:
-            rows.append([InlineKeyboardButton(text=btn.label, callback_data=f"node:{btn.target}")])
+            # id кнопки — для аналитики: из какого раздела пришли
+            rows.append([InlineKeyboardButton(text=btn.label, callback_data=f"node:{btn.target}:{btn.id}")])
     if not rows:
         return None
     return InlineKeyboardMarkup(inline_keyboard=rows)
@@ -683,6 +2895,8 @@ def admin_reply_kb() -> ReplyKeyboardMarkup:
             [KeyboardButton(text="📄 Разделы"), KeyboardButton(text="✏️ Изменить текст")],
             [KeyboardButton(text="➕ Добавить кнопку"), KeyboardButton(text="🔧 Изменить кнопку")],
             [KeyboardButton(text="🗑 Удалить кнопку"), KeyboardButton(text="♻️ Восстановить")],
+            [KeyboardButton(text="📣 Рассылка")],
+            [KeyboardButton(text="📦 Экспорт"), KeyboardButton(text="📥 Импорт")],
             [KeyboardButton(text="❌ Сброс"), KeyboardButton(text="🚪 Выйти")],
         ],
         resize_keyboard=True,
@@ -710,79 +2924,177 @@ def skip_or_reset_kb() -> ReplyKeyboardMarkup:
     )
 
 
-async def render_node(target: Message, slug: str) -> None:
-    node = await fetch_node(slug)
-    if not node:
+async def edit_in_place(message: Message, text: str, kb: Optional[InlineKeyboardMarkup]) -> bool:
+    """
+    Показать раздел в уже отправленном сообщении.
+    False — отредактировать не вышло (тот же контент, сообщение слишком старое
+    или удалено), тогда вызывающий отправляет новое.
+    """
+    try:
+        if message.html_text == text:
+            # текст тот же — достаточно поменять клавиатуру
+            await message.edit_reply_markup(reply_markup=kb)
+        else:
+            await message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        return False
+    return True
+
+
+async def render_node(target: MaybeInaccessibleMessageUnion, slug: str, *, edit: bool = False) -> None:
+    found = await fetch_node_with_buttons(slug)
+    if not found:
         await target.answer("Раздел не найден. Проверьте структуру или выполните «♻️ Восстановить».")
         return
-    buttons = await fetch_buttons(slug)
-    await target.answer(node.text, reply_markup=build_kb(buttons))
+    node, buttons = found
+    kb = node_kb(slug, buttons)
+    if edit and isinstance(target, Message) and await edit_in_place(target, node.text, kb):
+        return
+    await target.answer(node.text, reply_markup=kb)
+
+
+class RootLabel(Filter):
+    """
+    Текст совпадает с кнопкой корневого меню. Проверка по словарю из снимка,
+    без БД; в хэндлер передаётся target_slug.
+    """
+
+    async def __call__(self, m: Message) -> Union[bool, dict[str, Any]]:
+        text = m.text or ""
+        if not text or text.startswith("/"):
+            return False
+        target_slug = await find_root_target_by_label(text)
+        if not target_slug:
+            return False
+        return {"target_slug": target_slug}
+
+
+# ===== Routers =====
+class IsOwner(Filter):
+    async def __call__(self, event: Union[Message, CallbackQuery]) -> bool:
+        return event.from_user is not None and is_owner(event.from_user.id)
+
+
+class ExactCommand(Filter):
+    """
+    Команда админки по словарю: точный текст кнопки, а для «/команда аргументы» — первое слово.
+    Один поиск в dict вместо цепочки F.text == ... на каждое сообщение.
+    """
+
+    def __init__(self, table: Mapping[str, CallableObject]) -> None:
+        self.table = table
+
+    async def __call__(self, m: Message) -> Union[bool, dict[str, Any]]:
+        text = m.text or ""
+        command_handler = self.table.get(text)
+        if command_handler is None and text.startswith("/"):
+            command_handler = self.table.get(text.split(maxsplit=1)[0])
+        if command_handler is None:
+            return False
+        return {"command_handler": command_handler}
+
+
+# Только владелец: остальные апдейты отсекаются одним фильтром на уровне роутера
+admin = Router(name="admin")
+admin.message.filter(IsOwner())
+public = Router(name="public")
+# admin раньше public: кнопки админки и шаги FSM не перехватываются меню
+dp.include_routers(admin, public)
+
+# текст кнопки или /команда -> хэндлер
+ADMIN_COMMANDS: dict[str, CallableObject] = {}
+
+
+def admin_command(*texts: str) -> Callable[[Callable[..., Awaitable[Any]]], Callable[..., Awaitable[Any]]]:
+    def decorator(func: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+        command_handler = CallableObject(func)
+        for text in texts:
+            ADMIN_COMMANDS[text] = command_handler
+        return func
+
+    return decorator
+
+
+# регистрируется до шагов FSM: команды и кнопки админки работают в любом состоянии
+@admin.message(ExactCommand(ADMIN_COMMANDS))
+async def admin_command_dispatch(m: Message, command_handler: CallableObject, **data: Any) -> Any:
+    return await command_handler.call(m, **data)
 
 
 # ===== Public handlers =====
+# /start — на самом dp: проверяется раньше роутеров, то есть в любом состоянии FSM
 @dp.message(CommandStart())
-async def start(m: Message) -> None:
+async def start(m: Message, command: CommandObject) -> None:
+    USER_RECORDER.touch(m.from_user)
+    slug, payload = parse_start_payload(command.args)
+    if payload is not None:
+        # сразу в нужный раздел из снимка, без переходов root → ... → slug
+        found = slug is not None and await fetch_node(slug) is not None
+        DEEPLINK_STARTS.labels("found" if found else "unknown").inc()
+        DEEPLINK_COUNTER.hit(payload, slug if found else None)
+        if found and slug != "root":
+            CLICK_RECORDER.record(m.from_user.id if m.from_user else None, None, slug, None, "deeplink")
+            await render_node(m, slug)
+            return
+
+    CLICK_RECORDER.record(m.from_user.id if m.from_user else None, None, "root", None, "start")
+
     name = m.from_user.first_name if m.from_user else "друг"
-    node = await fetch_node("root")
-    if not node:
+    found = await fetch_node_with_buttons("root")
+    if not found:
         await m.answer("Меню ещё не настроено.")
         return
+    node, buttons = found
     text = node.text.replace("{name}", name)
-    buttons = await fetch_buttons("root")
-    await m.answer(text, reply_markup=build_root_reply_kb(buttons))
+    await m.answer(text, reply_markup=root_kb(buttons))
 
 
-@dp.message(F.text)
-async def root_menu_click(m: Message, state: FSMContext) -> None:
-    text = (m.text or "").strip()
-    if text.startswith("/"):
-        return
-    if await state.get_state():
-        return
-    target_slug = await find_root_target_by_label(text)
-    if not target_slug:
-        return
+# StateFilter(None) берёт состояние, уже прочитанное FSM-middleware, — отдельного запроса нет.
+# Обычный текст (не кнопка меню) сюда не попадает вовсе.
+@public.message(F.text, StateFilter(None), RootLabel())
+async def root_menu_click(m: Message, target_slug: str) -> None:
+    USER_RECORDER.touch(m.from_user)
+    root_buttons = MENU.buttons.get("root", ()) if MENU is not None else ()
+    button_id = next((b.id for b in root_buttons if b.target == target_slug), None)
+    CLICK_RECORDER.record(m.from_user.id if m.from_user else None, "root", target_slug, button_id, "reply")
     await render_node(m, target_slug)
 
 
-@dp.callback_query(F.data.startswith("node:"))
-async def cb_node(c: CallbackQuery) -> None:
-    slug = c.data.split(":", 1)[1]
-    await render_node(c.message, slug)
-    await c.answer()
+@public.callback_query(F.data.startswith("node:"))
+async def cb_node(c: CallbackQuery) -> AnswerCallbackQuery:
+    # node:<slug>:<button_id>; в старых сообщениях — просто node:<slug>
+    _, slug, *rest = c.data.split(":", 2)
+    button_id = int(rest[0]) if rest and rest[0].isdigit() else None
+    menu = MENU
+    entry = menu.button_index.get(button_id) if menu is not None and button_id is not None else None
+    CLICK_RECORDER.record(c.from_user.id, entry[0] if entry else None, slug, button_id, "inline")
+    await render_node(c.message, slug, edit=NAV_EDIT_IN_PLACE)
+    # возвращаем метод, а не вызываем: в webhook-режиме он уйдёт в ответе на сам webhook
+    return c.answer()
 
 
 # ===== Admin entry/exit =====
-@dp.message(F.text == "/admin")
+@admin_command("/admin")
 async def admin_help(m: Message) -> None:
-    if not m.from_user or not is_owner(m.from_user.id):
-        return
     await m.answer("Админ-режим включён.", reply_markup=admin_reply_kb())
 
 
-@dp.message(F.text == "🚪 Выйти")
+@admin_command("🚪 Выйти")
 async def admin_exit(m: Message, state: FSMContext) -> None:
-    if not m.from_user or not is_owner(m.from_user.id):
-        return
     await state.clear()
     await m.answer("Ок, вышла из админ-режима.", reply_markup=ReplyKeyboardRemove())
 
 
-@dp.message(F.text == "❌ Сброс")
+@admin_command("❌ Сброс")
 async def admin_reset(m: Message, state: FSMContext) -> None:
-    if not m.from_user or not is_owner(m.from_user.id):
-        return
     await state.clear()
     await m.answer("Сбросила текущие шаги.", reply_markup=admin_reply_kb())
 
 
 # ===== Admin: list nodes =====
-@dp.message(F.text == "📄 Разделы")
+@admin_command("📄 Разделы")
 async def list_nodes(m: Message) -> None:
-    if not m.from_user or not is_owner(m.from_user.id):
-        return
-    assert POOL is not None
-    async with POOL.acquire() as conn:
+    async with db_acquire() as conn:
         rows = await conn.fetch("SELECT slug FROM nodes ORDER BY slug")
     if not rows:
         await m.answer("Разделов нет.", reply_markup=admin_reply_kb())
@@ -791,51 +3103,44 @@ async def list_nodes(m: Message) -> None:
 
 
 # ===== Admin: repair (button) =====
-@dp.message(F.text == "♻️ Восстановить")
+@admin_command("♻️ Восстановить")
 async def admin_repair(m: Message) -> None:
-    if not m.from_user or not is_owner(m.from_user.id):
-        return
-    assert POOL is not None
-    async with POOL.acquire() as conn:
-        root_id = await ensure_node(conn, "root", DEFAULT_ROOT_TEXT)
-
-        await dedupe_buttons(conn)
-        await conn.execute(
-            """
-            CREATE UNIQUE INDEX IF NOT EXISTS ux_buttons_node_label
-            ON buttons (node_id, label);
-            """
-        )
+    async with db_acquire() as conn:
+        async with conn.transaction():
+            await dedupe_buttons(conn)
+            await conn.execute(
+                """
+                CREATE UNIQUE INDEX IF NOT EXISTS ux_buttons_node_label
+                ON buttons (node_id, label);
+                """
+            )
 
-        await seed_default_nodes(conn, root_id, replace_existing=True)
-        await migrate_support_contacts(conn)
-        await migrate_text_typos(conn)
-        await fix_root_placeholder_if_needed(conn)
-        await normalize_buttons(conn)
-        await dedupe_buttons(conn)
+            await seed_default_nodes(conn, replace_existing=True)
+            await migrate_support_contacts(conn)
+            await migrate_text_typos(conn)
+            await fix_root_placeholder_if_needed(conn)
+            await normalize_buttons(conn)
+            await dedupe_buttons(conn)
+            await publish_menu_change(conn)
 
+    await reload_menu()
     await m.answer("Готово. Структура пересобрана.", reply_markup=admin_reply_kb())
 
 
 # ===== Admin: edit text flow =====
-@dp.message(F.text == "✏️ Изменить текст")
+@admin_command("✏️ Изменить текст")
 async def edit_text_start(m: Message, state: FSMContext) -> None:
-    if not m.from_user or not is_owner(m.from_user.id):
-        return
     await state.set_state(EditTextFlow.slug)
     await m.answer("Введи slug раздела, который нужно изменить:", reply_markup=ReplyKeyboardRemove())
 
 
-@dp.message(EditTextFlow.slug)
+@admin.message(EditTextFlow.slug)
 async def edit_text_slug(m: Message, state: FSMContext) -> None:
-    if not m.from_user or not is_owner(m.from_user.id):
-        return
     slug = (m.text or "").strip()
     if not slug:
         await m.answer("Slug пустой. Введи slug раздела:")
         return
-    assert POOL is not None
-    async with POOL.acquire() as conn:
+    async with db_acquire() as conn:
         exists = await conn.fetchval("SELECT 1 FROM nodes WHERE slug=$1", slug)
     if not exists:
         await m.answer("Раздел не найден. Введи slug ещё раз (или нажми ❌ Сброс):", reply_markup=admin_reply_kb())
@@ -847,10 +3152,8 @@ async def edit_text_slug(m: Message, state: FSMContext) -> None:
     await m.answer("Ок. Теперь отправь новый текст раздела (можно с переносами):")
 
 
-@dp.message(EditTextFlow.text)
+@admin.message(EditTextFlow.text)
 async def edit_text_save(m: Message, state: FSMContext) -> None:
-    if not m.from_user or not is_owner(m.from_user.id):
-        return
     new_text = (m.text or "").strip()
     data = await state.get_data()
     slug = data.get("slug")
@@ -859,30 +3162,27 @@ async def edit_text_save(m: Message, state: FSMContext) -> None:
         await m.answer("Состояние потерялось. Нажми ✏️ Изменить текст заново.", reply_markup=admin_reply_kb())
         return
 
-    assert POOL is not None
-    async with POOL.acquire() as conn:
-        await conn.execute("UPDATE nodes SET text=$1 WHERE slug=$2", new_text, slug)
+    async with db_acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("UPDATE nodes SET text=$1 WHERE slug=$2", new_text, slug)
+            version = await publish_menu_change(conn, [slug])
 
+    await reload_menu([slug], version)
     await state.clear()
     await m.answer(f"Готово. Текст раздела «{slug}» обновлён.", reply_markup=admin_reply_kb())
 
 
 # ===== Admin: add button flow =====
-@dp.message(F.text == "➕ Добавить кнопку")
+@admin_command("➕ Добавить кнопку")
 async def add_button_start(m: Message, state: FSMContext) -> None:
-    if not m.from_user or not is_owner(m.from_user.id):
-        return
     await state.set_state(AddButtonFlow.slug)
     await m.answer("В какой раздел добавить кнопку? Введи slug:", reply_markup=ReplyKeyboardRemove())
 
 
-@dp.message(AddButtonFlow.slug)
+@admin.message(AddButtonFlow.slug)
 async def add_button_slug(m: Message, state: FSMContext) -> None:
-    if not m.from_user or not is_owner(m.from_user.id):
-        return
     slug = (m.text or "").strip()
-    assert POOL is not None
-    async with POOL.acquire() as conn:
+    async with db_acquire() as conn:
         node_id = await conn.fetchval("SELECT id FROM nodes WHERE slug=$1", slug)
     if not node_id:
         await m.answer("Такого slug нет. Введи slug ещё раз:", reply_markup=ReplyKeyboardRemove())
@@ -893,10 +3193,8 @@ async def add_button_slug(m: Message, state: FSMContext) -> None:
     await m.answer("Текст кнопки (label):")
 
 
-@dp.message(AddButtonFlow.label)
+@admin.message(AddButtonFlow.label)
 async def add_button_label(m: Message, state: FSMContext) -> None:
-    if not m.from_user or not is_owner(m.from_user.id):
-        return
     label = (m.text or "").strip()
     if not label:
         await m.answer("Label пустой. Введи текст кнопки:")
@@ -906,10 +3204,8 @@ async def add_button_label(m: Message, state: FSMContext) -> None:
     await m.answer("Тип кнопки: node или url?", reply_markup=choose_action_kb())
 
 
-@dp.message(AddButtonFlow.action)
+@admin.message(AddButtonFlow.action)
 async def add_button_action(m: Message, state: FSMContext) -> None:
-    if not m.from_user or not is_owner(m.from_user.id):
-        return
     action = (m.text or "").strip().lower()
     if action not in ("node", "url"):
         await m.answer("Выбери: node или url", reply_markup=choose_action_kb())
@@ -923,17 +3219,14 @@ async def add_button_action(m: Message, state: FSMContext) -> None:
         await m.answer("Введи ссылку (https://...):", reply_markup=ReplyKeyboardRemove())
 
 
-@dp.message(AddButtonFlow.target)
+@admin.message(AddButtonFlow.target)
 async def add_button_target(m: Message, state: FSMContext) -> None:
-    if not m.from_user or not is_owner(m.from_user.id):
-        return
     target = (m.text or "").strip()
     data = await state.get_data()
     action = data.get("action")
 
     if action == "node":
-        assert POOL is not None
-        async with POOL.acquire() as conn:
+        async with db_acquire() as conn:
             exists = await conn.fetchval("SELECT 1 FROM nodes WHERE slug=$1", target)
         if not exists:
             await m.answer("Такого раздела нет. Введи slug ещё раз:")
@@ -952,10 +3245,8 @@ async def add_button_target(m: Message, state: FSMContext) -> None:
     await m.answer("Позиция (число). Или нажми «Пропустить» (будет 0):", reply_markup=skip_or_reset_kb())
 
 
-@dp.message(AddButtonFlow.position)
+@admin.message(AddButtonFlow.position)
 async def add_button_position(m: Message, state: FSMContext) -> None:
-    if not m.from_user or not is_owner(m.from_user.id):
-        return
     txt = (m.text or "").strip()
     pos = 0
     if txt.lower() != "пропустить":
@@ -965,44 +3256,42 @@ async def add_button_position(m: Message, state: FSMContext) -> None:
         pos = int(txt)
 
     data = await state.get_data()
+    slug = data.get("slug")
     node_id = data.get("node_id")
     label = data.get("label")
     action = data.get("action")
     target = data.get("target")
 
-    if not all([node_id, label, action, target]):
+    if not all([slug, node_id, label, action, target]):
         await state.clear()
         await m.answer("Состояние потерялось. Начни заново.", reply_markup=admin_reply_kb())
         return
 
-    assert POOL is not None
-    async with POOL.acquire() as conn:
-        await ensure_button(conn, int(node_id), str(label), str(action), str(target), pos)
+    async with db_acquire() as conn:
+        async with conn.transaction():
+            await ensure_button(conn, int(node_id), str(label), str(action), str(target), pos)
+            version = await publish_menu_change(conn, [str(slug)])
 
+    await reload_menu([str(slug)], version)
     await state.clear()
     await m.answer("Кнопка добавлена/обновлена ✅", reply_markup=admin_reply_kb())
 
 
 # ===== Admin: edit button flow =====
-@dp.message(F.text == "🔧 Изменить кнопку")
+@admin_command("🔧 Изменить кнопку")
 async def edit_button_start(m: Message, state: FSMContext) -> None:
-    if not m.from_user or not is_owner(m.from_user.id):
-        return
     await state.set_state(EditButtonFlow.button_id)
     await m.answer("Введи ID кнопки (число). Можно посмотреть через /node <slug>:", reply_markup=ReplyKeyboardRemove())
 
 
-@dp.message(EditButtonFlow.button_id)
+@admin.message(EditButtonFlow.button_id)
 async def edit_button_id(m: Message, state: FSMContext) -> None:
-    if not m.from_user or not is_owner(m.from_user.id):
-        return
     if not (m.text or "").strip().isdigit():
         await m.answer("Нужен числовой ID. Введи ID кнопки:")
         return
     btn_id = int((m.text or "").strip())
 
-    assert POOL is not None
-    async with POOL.acquire() as conn:
+    async with db_acquire() as conn:
         row = await conn.fetchrow(
             "SELECT id, node_id, label, action_type, target, position FROM buttons WHERE id=$1",
             btn_id,
@@ -1023,10 +3312,8 @@ async def edit_button_id(m: Message, state: FSMContext) -> None:
     await m.answer(f"Текущий label: «{row['label']}»\nОтправь новый label или нажми «Оставить».", reply_markup=keep_or_reset_kb())
 
 
-@dp.message(EditButtonFlow.label)
+@admin.message(EditButtonFlow.label)
 async def edit_button_label(m: Message, state: FSMContext) -> None:
-    if not m.from_user or not is_owner(m.from_user.id):
-        return
     txt = (m.text or "").strip()
     data = await state.get_data()
     new_label = data.get("current_label") if txt.lower() == "оставить" else txt
@@ -1045,10 +3332,8 @@ async def edit_button_label(m: Message, state: FSMContext) -> None:
     )
 
 
-@dp.message(EditButtonFlow.action)
+@admin.message(EditButtonFlow.action)
 async def edit_button_action(m: Message, state: FSMContext) -> None:
-    if not m.from_user or not is_owner(m.from_user.id):
-        return
     txt = (m.text or "").strip().lower()
     data = await state.get_data()
     action = data.get("current_action") if txt == "оставить" else txt
@@ -1065,10 +3350,8 @@ async def edit_button_action(m: Message, state: FSMContext) -> None:
     )
 
 
-@dp.message(EditButtonFlow.target)
+@admin.message(EditButtonFlow.target)
 async def edit_button_target(m: Message, state: FSMContext) -> None:
-    if not m.from_user or not is_owner(m.from_user.id):
-        return
     txt = (m.text or "").strip()
     data = await state.get_data()
     action = data.get("action") or data.get("current_action")
@@ -1079,8 +3362,7 @@ async def edit_button_target(m: Message, state: FSMContext) -> None:
         return
 
     if action == "node":
-        assert POOL is not None
-        async with POOL.acquire() as conn:
+        async with db_acquire() as conn:
             exists = await conn.fetchval("SELECT 1 FROM nodes WHERE slug=$1", target)
         if not exists:
             await m.answer("Такого раздела (slug) нет. Введи target ещё раз:", reply_markup=keep_or_reset_kb())
@@ -1099,10 +3381,8 @@ async def edit_button_target(m: Message, state: FSMContext) -> None:
     )
 
 
-@dp.message(EditButtonFlow.position)
+@admin.message(EditButtonFlow.position)
 async def edit_button_position(m: Message, state: FSMContext) -> None:
-    if not m.from_user or not is_owner(m.from_user.id):
-        return
     txt = (m.text or "").strip()
     data = await state.get_data()
 
@@ -1120,21 +3400,24 @@ async def edit_button_position(m: Message, state: FSMContext) -> None:
     action = str(data.get("action") or data.get("current_action"))
     target = str(data.get("target") or data.get("current_target"))
 
-    assert POOL is not None
-    async with POOL.acquire() as conn:
+    async with db_acquire() as conn:
         try:
-            await conn.execute(
-                """
-                UPDATE buttons
-                SET label=$1, action_type=$2, target=$3, position=$4
-                WHERE id=$5
-                """,
-                label,
-                action,
-                target,
-                pos,
-                btn_id,
-            )
+            async with conn.transaction():
+                slug = await conn.fetchval(
+                    """
+                    UPDATE buttons b
+                    SET label=$1, action_type=$2, target=$3, position=$4
+                    FROM nodes n
+                    WHERE b.id=$5 AND n.id = b.node_id
+                    RETURNING n.slug
+                    """,
+                    label,
+                    action,
+                    target,
+                    pos,
+                    btn_id,
+                )
+                version = await publish_menu_change(conn, [slug] if slug else [])
         except asyncpg.UniqueViolationError:
             await m.answer(
                 "В этом разделе уже есть кнопка с таким label (уникальность по (node_id, label)). "
@@ -1144,66 +3427,268 @@ async def edit_button_position(m: Message, state: FSMContext) -> None:
             await state.clear()
             return
 
+    await reload_menu([slug] if slug else [], version)
     await state.clear()
     await m.answer("Кнопка обновлена ✅", reply_markup=admin_reply_kb())
 
 
 # ===== Admin: delete button flow =====
-@dp.message(F.text == "🗑 Удалить кнопку")
+@admin_command("🗑 Удалить кнопку")
 async def delete_button_start(m: Message, state: FSMContext) -> None:
-    if not m.from_user or not is_owner(m.from_user.id):
-        return
     await state.set_state(DeleteButtonFlow.button_id)
     await m.answer("Введи ID кнопки для удаления:", reply_markup=ReplyKeyboardRemove())
 
 
-@dp.message(DeleteButtonFlow.button_id)
+@admin.message(DeleteButtonFlow.button_id)
 async def delete_button_do(m: Message, state: FSMContext) -> None:
-    if not m.from_user or not is_owner(m.from_user.id):
-        return
     if not (m.text or "").strip().isdigit():
         await m.answer("Нужен числовой ID. Введи ID кнопки:")
         return
     btn_id = int((m.text or "").strip())
 
-    assert POOL is not None
-    async with POOL.acquire() as conn:
-        res = await conn.execute("DELETE FROM buttons WHERE id=$1", btn_id)
+    async with db_acquire() as conn:
+        async with conn.transaction():
+            slug = await conn.fetchval(
+                """
+                DELETE FROM buttons b
+                USING nodes n
+                WHERE b.id=$1 AND n.id = b.node_id
+                RETURNING n.slug
+                """,
+                btn_id,
+            )
+            if slug:
+                version = await publish_menu_change(conn, [slug])
 
     await state.clear()
-    if res.endswith("0"):
+    if not slug:
         await m.answer("Кнопка не найдена.", reply_markup=admin_reply_kb())
         return
+    await reload_menu([slug], version)
     await m.answer("Кнопка удалена ✅", reply_markup=admin_reply_kb())
 
 
+# ===== Admin: broadcast flow =====
+@admin_command("📣 Рассылка")
+async def broadcast_start(m: Message, state: FSMContext) -> None:
+    await state.set_state(BroadcastFlow.text)
+    await m.answer("Отправь текст рассылки (форматирование сохранится):", reply_markup=ReplyKeyboardRemove())
+
+
+@admin.message(BroadcastFlow.text)
+async def broadcast_text(m: Message, state: FSMContext) -> None:
+    if not m.text:
+        await m.answer("Нужен текст. Отправь текст рассылки:")
+        return
+    async with db_acquire() as conn:
+        total = await conn.fetchval("SELECT count(*) FROM users WHERE NOT blocked")
+
+    await state.update_data(text=m.html_text)
+    await state.set_state(BroadcastFlow.confirm)
+    await m.answer(m.html_text)
+    await m.answer(
+        f"Получателей: {total}. Отправить?",
+        reply_markup=ReplyKeyboardMarkup(
+            keyboard=[[KeyboardButton(text="Отправить"), KeyboardButton(text="❌ Сброс")]],
+            resize_keyboard=True,
+        ),
+    )
+
+
+@admin.message(BroadcastFlow.confirm)
+async def broadcast_confirm(m: Message, state: FSMContext) -> None:
+    if (m.text or "").strip().lower() != "отправить":
+        await m.answer("Нажми «Отправить» или «❌ Сброс».")
+        return
+    data = await state.get_data()
+    text = data.get("text")
+    await state.clear()
+    if not text:
+        await m.answer("Состояние потерялось. Начни заново.", reply_markup=admin_reply_kb())
+        return
+
+    async with db_acquire() as conn:
+        broadcast_id = await conn.fetchval("INSERT INTO broadcasts (text) VALUES ($1) RETURNING id", text)
+    start_broadcast(m.bot, broadcast_id)
+    await m.answer(
+        f"Рассылка #{broadcast_id} запущена. Прогресс: /broadcasts, остановить: /broadcast_stop {broadcast_id}",
+        reply_markup=admin_reply_kb(),
+    )
+
+
+# ===== Admin: menu export / import =====
+@admin_command("📦 Экспорт")
+async def export_menu(m: Message) -> None:
+    menu = MENU
+    if menu is None:
+        await m.answer("Меню ещё не загружено.", reply_markup=admin_reply_kb())
+        return
+    payload = json.dumps(snapshot_to_dict(menu), ensure_ascii=False, indent=1).encode()
+    await m.answer_document(
+        BufferedInputFile(payload, filename=f"menu-v{menu.version}.json"),
+        caption=f"Меню, версия {menu.version}: {len(menu.nodes)} разделов.",
+        reply_markup=admin_reply_kb(),
+    )
+
+
+@admin_command("📥 Импорт")
+async def import_menu_start(m: Message, state: FSMContext) -> None:
+    await state.set_state(ImportMenuFlow.file)
+    await m.answer(
+        "Пришли JSON-файл меню (как из «📦 Экспорт»). Перед заменой покажу, что изменится.",
+        reply_markup=ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="❌ Сброс")]], resize_keyboard=True),
+    )
+
+
+@admin.message(ImportMenuFlow.file)
+async def import_menu_file(m: Message, state: FSMContext) -> None:
+    if not m.document:
+        await m.answer("Нужен файл. Пришли JSON или нажми «❌ Сброс».")
+        return
+    if (m.document.file_size or 0) > 1_000_000:
+        await m.answer("Файл больше 1 МБ — это точно не меню.")
+        return
+
+    raw = await m.bot.download(m.document)
+    try:
+        data = json.loads(raw.read().decode("utf-8"))
+        snapshot = snapshot_from_dict(data)
+    except (UnicodeDecodeError, json.JSONDecodeError, ValueError) as e:
+        await m.answer(f"Не получилось прочитать снимок: {e}")
+        return
+
+    current = MENU
+    changes = diff_snapshots(current, snapshot) if current is not None else []
+    if current is not None and not changes:
+        await state.clear()
+        await m.answer("Снимок совпадает с текущим меню, менять нечего.", reply_markup=admin_reply_kb())
+        return
+
+    await state.update_data(snapshot=data)
+    await state.set_state(ImportMenuFlow.confirm)
+    preview = changes[:40]
+    if len(changes) > len(preview):
+        preview.append(f"…и ещё {len(changes) - len(preview)}")
+    warnings = dangling_targets(snapshot)
+    text = "Изменения:\n" + "\n".join(preview) if preview else "Текущее меню не загружено, снимок заменит всё."
+    if warnings:
+        text += "\n\nКнопки в несуществующие разделы:\n" + "\n".join(warnings[:10])
+    await m.answer(text[:4000])
+    await m.answer(
+        f"Разделов в снимке: {len(snapshot.nodes)}. Применить?",
+        reply_markup=ReplyKeyboardMarkup(
+            keyboard=[[KeyboardButton(text="Применить"), KeyboardButton(text="❌ Сброс")]],
+            resize_keyboard=True,
+        ),
+    )
+
+
+@admin.message(ImportMenuFlow.confirm)
+async def import_menu_confirm(m: Message, state: FSMContext) -> None:
+    if (m.text or "").strip().lower() != "применить":
+        await m.answer("Нажми «Применить» или «❌ Сброс».")
+        return
+    data = await state.get_data()
+    await state.clear()
+    try:
+        snapshot = snapshot_from_dict(data.get("snapshot"))
+    except ValueError:
+        await m.answer("Состояние потерялось. Начни заново.", reply_markup=admin_reply_kb())
+        return
+
+    async with db_acquire() as conn:
+        version = await import_menu(conn, snapshot)
+    await reload_menu()
+    await m.answer(f"Готово. Меню заменено, версия {version}.", reply_markup=admin_reply_kb())
+
+
 # ===== Команды (оставлены как запасной вариант) =====
-@dp.message(F.text == "/cancel")
+@admin_command("/cancel")
 async def cancel_flow(m: Message, state: FSMContext) -> None:
-    if not m.from_user or not is_owner(m.from_user.id):
-        return
     await state.clear()
     await m.answer("Ок, сбросила шаги.", reply_markup=admin_reply_kb())
 
 
-@dp.message(F.text == "/repair")
+@admin_command("/queue")
+async def send_queue_cmd(m: Message) -> None:
+    st = SEND_SCHEDULER.stats()
+    ex = UPDATE_EXECUTOR.stats()
+    await m.answer(
+        "Очередь отправки:\n"
+        f"ответы: {st['queue_interactive']}, рассылка: {st['queue_bulk']}\n"
+        f"отправлено: {st['sent']}, retry_after: {st['retry_after']}\n"
+        f"ожидание: avg {st['wait_avg']:.3f}s, p95 {st['wait_p95']:.3f}s, max {st['wait_max']:.3f}s\n\n"
+        f"Апдейты: в работе {ex['running']}/{UPDATE_WORKERS}, "
+        f"принято {ex['in_flight']}/{UPDATE_QUEUE_LIMIT}, чатов {ex['chats']}",
+        reply_markup=admin_reply_kb(),
+    )
+
+
+@admin_command("/broadcasts")
+async def broadcasts_cmd(m: Message) -> None:
+    async with db_acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT id, status, sent, failed, created_at FROM broadcasts ORDER BY id DESC LIMIT 10"
+        )
+    if not rows:
+        await m.answer("Рассылок не было.", reply_markup=admin_reply_kb())
+        return
+    lines = [
+        f"#{row['id']} | {row['status']} | доставлено {row['sent']}, ошибок {row['failed']} | "
+        f"{row['created_at']:%d.%m %H:%M}"
+        for row in rows
+    ]
+    await m.answer("Рассылки:\n" + "\n".join(lines), reply_markup=admin_reply_kb())
+
+
+@admin_command("/broadcast_stop")
+async def broadcast_stop_cmd(m: Message) -> None:
+    parts = m.text.split(maxsplit=1)
+    arg = parts[1].strip() if len(parts) > 1 else ""
+    if not arg.isdigit():
+        await m.answer("Формат: /broadcast_stop <id>", reply_markup=admin_reply_kb())
+        return
+    async with db_acquire() as conn:
+        res = await conn.execute(
+            "UPDATE broadcasts SET status='cancelled', finished_at=now() WHERE id=$1 AND status='running'",
+            int(arg),
+        )
+    if res.endswith("0"):
+        await m.answer("Активной рассылки с таким ID нет.", reply_markup=admin_reply_kb())
+        return
+    await m.answer("Остановила. Уже отправленное не отзывается.", reply_markup=admin_reply_kb())
+
+
+@admin_command("/db")
+async def db_pool_cmd(m: Message) -> None:
+    st = POOL_STATS.stats()
+    await m.answer(
+        "Пул БД:\n"
+        f"соединений: {st['size']}/{st['max_size']}, свободно: {st['idle']}, занято: {st['in_use']}\n"
+        f"ждут соединения: {st['waiting']}, таймаутов: {st['timeouts']}\n"
+        f"ожидание: avg {st['wait_avg']:.3f}s, p95 {st['wait_p95']:.3f}s, max {st['wait_max']:.3f}s",
+        reply_markup=admin_reply_kb(),
+    )
+
+
+@admin_command("/repair")
 async def repair_seed_cmd(m: Message) -> None:
     # на всякий — если удобнее командой
-    if not m.from_user or not is_owner(m.from_user.id):
-        return
     await admin_repair(m)
 
 
-@dp.message(F.text.startswith("/node "))
+@admin_command("/node")
 async def show_node_cmd(m: Message) -> None:
-    if not m.from_user or not is_owner(m.from_user.id):
+    parts = m.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await m.answer("Формат: /node <slug>", reply_markup=admin_reply_kb())
         return
-    slug = m.text.split(maxsplit=1)[1].strip()
-    node = await fetch_node(slug)
-    if not node:
+    slug = parts[1].strip()
+    found = await fetch_node_with_buttons(slug)
+    if not found:
         await m.answer("Раздел не найден.", reply_markup=admin_reply_kb())
         return
-    buttons = await fetch_buttons(slug)
+    node, buttons = found
     if buttons:
         btn_lines = [
             f"#{btn.id} | {btn.label} | {btn.action_type}:{btn.target} | pos={btn.position}"
@@ -1215,9 +3700,229 @@ async def show_node_cmd(m: Message) -> None:
     await m.answer(f"{node.text}\n\nКнопки:\n{btn_text}", reply_markup=admin_reply_kb())
 
 
+@admin_command("/link")
+async def deeplink_cmd(m: Message) -> None:
+    parts = m.text.split()[1:]
+    if not parts:
+        await m.answer("Формат: /link <slug> [метка]", reply_markup=admin_reply_kb())
+        return
+    slug, tag = parts[0], (parts[1] if len(parts) > 1 else "")
+    payload = f"{slug}{DEEPLINK_TAG_SEPARATOR}{tag}" if tag else slug
+    if not await fetch_node(slug):
+        await m.answer("Раздел не найден.", reply_markup=admin_reply_kb())
+        return
+    if not is_deeplink_payload(payload):
+        await m.answer("Telegram принимает в ссылке только A-Z, a-z, 0-9, _ и - (до 64 символов).")
+        return
+    if tag:
+        await DEEPLINK_COUNTER.register(payload, slug)
+    # нужен только владельцу — не тянем при старте
+    from aiogram.utils.deep_linking import create_start_link
+
+    link = await create_start_link(m.bot, payload)
+    await m.answer(f"Ссылка на «{slug}»:\n{link}", reply_markup=admin_reply_kb())
+
+
+@admin_command("/campaigns")
+async def campaigns_cmd(m: Message) -> None:
+    await DEEPLINK_COUNTER.flush()
+    async with db_acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT payload, slug, starts, last_at FROM deeplink_stats ORDER BY starts DESC LIMIT 20"
+        )
+    if not rows:
+        await m.answer(
+            "Переходов по ссылкам ещё не было. Ссылка на раздел: /link <slug> [метка]",
+            reply_markup=admin_reply_kb(),
+        )
+        return
+    lines = [
+        f"{row['payload']}: {row['starts']}" + (" (неизвестный раздел или метка)" if row["payload"] == DEEPLINK_OTHER else "")
+        for row in rows
+    ]
+    await m.answer("Переходы по deep link (/start):\n" + "\n".join(lines), reply_markup=admin_reply_kb())
+
+
+@admin_command("/funnel")
+async def funnel_cmd(m: Message) -> None:
+    parts = m.text.split()
+    if len(parts) > 1 and not parts[1].isdigit():
+        await m.answer("Формат: /funnel [дней]", reply_markup=admin_reply_kb())
+        return
+    days = int(parts[1]) if len(parts) > 1 else 7
+    menu = MENU
+    courses = course_slugs(menu) if menu is not None else []
+    await CLICK_RECORDER.flush()
+    async with db_acquire() as conn:
+        totals = await conn.fetchrow(
+            """
+            WITH ev AS (SELECT * FROM nav_events WHERE at > now() - make_interval(days => $1))
+            SELECT
+                (SELECT count(DISTINCT user_id) FROM ev WHERE target = 'root') AS root_users,
+                (SELECT count(DISTINCT user_id) FROM ev WHERE source <> 'url' AND target = ANY($2::text[]))
+                    AS course_users,
+                (SELECT count(*) FROM ev WHERE source = 'url' AND from_slug = ANY($2::text[])) AS buy_clicks
+            """,
+            days,
+            courses,
+        )
+        rows = await conn.fetch(
+            """
+            SELECT slug,
+                   count(*) FILTER (WHERE source <> 'url' AND target = slug) AS opens,
+                   count(DISTINCT user_id) FILTER (WHERE source <> 'url' AND target = slug) AS users,
+                   count(*) FILTER (WHERE source = 'url' AND from_slug = slug) AS buy_clicks
+            FROM unnest($2::text[]) AS slug
+            JOIN nav_events ev ON (ev.target = slug OR ev.from_slug = slug)
+                AND ev.at > now() - make_interval(days => $1)
+            GROUP BY slug
+            ORDER BY opens DESC
+            """,
+            days,
+            courses,
+        )
+    lines = [
+        f"Воронка за {days} дн.:",
+        f"root: {totals['root_users']} польз.",
+        f"→ раздел курса: {totals['course_users']} польз.",
+        f"→ кнопка оплаты: {totals['buy_clicks']} кликов"
+        + ("" if TRACK_URL_CLICKS else " (клики по ссылкам не считаются: TRACK_URL_CLICKS=0)"),
+    ]
+    if rows:
+        lines.append("")
+        lines += [f"{r['slug']}: {r['opens']} откр., {r['users']} польз., {r['buy_clicks']} оплат" for r in rows]
+    await m.answer("\n".join(lines), reply_markup=admin_reply_kb())
+
+
 # ===== Main =====
-async def main() -> None:
+async def connect_db() -> None:
+    """Пул, миграции и меню из БД; при ошибке пул не остаётся полуподнятым."""
+    global POOL
+    POOL = await create_db_pool()
+    try:
+        await warmup_pool()
+        await init_db()
+        await reload_menu()
+    except BaseException:
+        POOL.terminate()
+        POOL = None
+        raise
+
+
+def start_db_tasks() -> list[asyncio.Task]:
+    return [
+        asyncio.create_task(run_menu_listener()),
+        asyncio.create_task(USER_RECORDER.run()),
+        asyncio.create_task(DEEPLINK_COUNTER.run()),
+        asyncio.create_task(CLICK_RECORDER.run()),
+        asyncio.create_task(FSM_STORAGE.run_sweeper()),
+    ]
+
+
+async def reconnect_db(bot: Bot, background: list[asyncio.Task]) -> None:
+    """Меню работает из файла — фоном ждём БД, потом выходим из режима «только чтение»."""
+    global MENU_READ_ONLY
+    delay = 5.0
+    while True:
+        await asyncio.sleep(delay)
+        try:
+            await connect_db()
+        except DB_OUTAGE_ERRORS as e:
+            logger.warning("Database still unavailable (%r), retrying in %.0fs", e, delay)
+            delay = min(delay * 2, 60.0)
+            continue
+        except Exception:
+            logger.exception("Failed to reconnect to the database")
+            delay = min(delay * 2, 60.0)
+            continue
+        MENU_READ_ONLY = False
+        background += start_db_tasks()
+        await resume_broadcasts(bot)
+        logger.warning("Database is back, menu is read-write again")
+        return
+
+
+async def prepare_delivery(bot: Bot) -> None:
+    if WEBHOOK_BASE_URL:
+        await bot.set_webhook(
+            WEBHOOK_BASE_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            # больше параллельных запросов Telegram не пришлёт — это и есть backpressure
+            max_connections=min(100, UPDATE_QUEUE_LIMIT),
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    else:
+        # иначе getUpdates упадёт с конфликтом, если раньше стоял webhook
+        await bot.delete_webhook()
+
+
+@web.middleware
+async def wait_ready(request: web.Request, handler: Callable[[web.Request], Awaitable[web.StreamResponse]]) -> web.StreamResponse:
+    """Webhook, пришедший во время старта (он же нас и разбудил), ждёт готовности, а не падает."""
+    if request.path == WEBHOOK_PATH and STOPPING.is_set():
+        # Telegram повторит апдейт позже — его заберёт уже новый инстанс
+        return web.Response(status=503, text="stopping")
+    if request.path == WEBHOOK_PATH and not READY.is_set():
+        try:
+            await asyncio.wait_for(READY.wait(), timeout=STARTUP_WEBHOOK_WAIT)
+        except asyncio.TimeoutError:
+            return web.Response(status=503, text="starting")
+    response = await handler(request)
+    if request.path == WEBHOOK_PATH and response.status == 200:
+        mark_updates_received()
+    return response
+
+
+async def shutdown(bot: Bot, runner: web.AppRunner, background: list[asyncio.Task]) -> None:
+    """
+    Порядок важен: приём апдейтов уже остановлен → дожидаемся начатых хендлеров →
+    останавливаем фоновые задачи и сбрасываем буферы → закрываем сессию бота, пул, веб-сервер.
+    """
     global POOL
+    STOPPING.set()
+    left = await UPDATE_EXECUTOR.drain(SHUTDOWN_DRAIN_TIMEOUT)
+    if left:
+        logger.warning("Shutdown: %s updates still running after %.0fs, cutting them off", left, SHUTDOWN_DRAIN_TIMEOUT)
+
+    if WEBHOOK_BASE_URL and WEBHOOK_DELETE_ON_SHUTDOWN:
+        try:
+            await bot.delete_webhook()
+        except TelegramAPIError:
+            logger.exception("Failed to delete webhook on shutdown")
+
+    # рассылки сохраняют прогресс при отмене и продолжатся со следующего старта
+    tasks = [*background, *BROADCAST_TASKS]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    try:
+        await USER_RECORDER.flush()
+    except Exception:
+        logger.exception("Failed to flush users on shutdown")
+    try:
+        await DEEPLINK_COUNTER.flush()
+    except Exception:
+        logger.exception("Failed to flush deep link counters on shutdown")
+    try:
+        await CLICK_RECORDER.flush()
+    except Exception:
+        logger.exception("Failed to flush %s clicks on shutdown", len(CLICK_RECORDER.buffer))
+
+    await bot.session.close()
+    if POOL is not None:
+        try:
+            await asyncio.wait_for(POOL.close(), timeout=5)
+        except asyncio.TimeoutError:
+            logger.warning("Shutdown: pool did not close in time, terminating connections")
+            POOL.terminate()
+        POOL = None
+    await runner.cleanup()
+    logger.info("Shutdown complete")
+
+
+async def main() -> None:
+    global MENU, MENU_READ_ONLY
+    started = time.monotonic()
     if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN is empty. Set it in environment variables.")
     if not DATABASE_URL:
@@ -1225,32 +3930,111 @@ async def main() -> None:
     if OWNER_ID == 0:
         raise RuntimeError("OWNER_ID is empty. Set it in environment variables.")
 
-    POOL = await asyncpg.create_pool(DATABASE_URL)
-    await init_db()
+    session = MenuSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else PRODUCTION)
+    session.middleware(SEND_SCHEDULER)
+    session.middleware(TelegramMetrics())
+    bot = Bot(BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 
-    bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-
-    app = web.Application()
+    # health-сервер поднимаем первым: проверки Render и пробуждение не ждут БД и Telegram
+    app = web.Application(middlewares=[wait_ready])
 
     async def health(_: web.Request) -> web.Response:
         return web.Response(text="ok")
 
     app.router.add_get("/", health)
     app.router.add_get("/health", health)
+    app.router.add_get("/livez", livez)
+    app.router.add_get("/readyz", readyz)
+    app.router.add_get("/metrics", metrics_handler)
+    if TRACK_URL_CLICKS:
+        app.router.add_get("/go/{button_id}", go_redirect)
+
+    if WEBHOOK_BASE_URL:
+        from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+        SimpleRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            secret_token=WEBHOOK_SECRET,
+            handle_in_background=not WEBHOOK_INLINE_ANSWERS,
+        ).register(app, path=WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, STOPPING.set)
+        except NotImplementedError:  # Windows
+            pass
 
     runner = web.AppRunner(app)
     await runner.setup()
     port = int(os.getenv("PORT", "10000"))
     site = web.TCPSite(runner, "0.0.0.0", port)
     await site.start()
+    logger.info("Health server is listening on :%s after %.2fs", port, time.monotonic() - started)
 
+    # последний снимок с диска: отвечать можно, не дожидаясь БД; потом его заменит свежий
+    if MENU_SNAPSHOT_PATH and os.path.exists(MENU_SNAPSHOT_PATH):
+        try:
+            MENU = load_snapshot_file(MENU_SNAPSHOT_PATH)
+        except (OSError, ValueError):
+            logger.exception("Failed to load menu snapshot from %s", MENU_SNAPSHOT_PATH)
+
+    background = [asyncio.create_task(monitor_loop_lag())]
     try:
-        await dp.start_polling(bot)
+        # БД, getMe и webhook — независимые сетевые походы, ждём их одновременно
+        db_result, *telegram_results = await asyncio.gather(
+            connect_db(), bot.me(), prepare_delivery(bot), return_exceptions=True
+        )
+        for result in telegram_results:
+            if isinstance(result, BaseException):
+                raise result
+        if isinstance(db_result, DB_OUTAGE_ERRORS) and MENU is not None:
+            logger.error("Database is unavailable, serving menu from %s (read-only): %r", MENU_SNAPSHOT_PATH, db_result)
+            MENU_READ_ONLY = True
+            background.append(asyncio.create_task(reconnect_db(bot, background)))
+        elif isinstance(db_result, BaseException):
+            raise db_result
+        else:
+            background += start_db_tasks()
+            await resume_broadcasts(bot)
+
+        if KEEP_WARM_INTERVAL > 0:
+            background.append(asyncio.create_task(keep_warm()))
+        READY.set()
+        STARTUP_SECONDS.set(time.monotonic() - started)
+        logger.info("Ready in %.2fs%s", time.monotonic() - started, " (read-only menu)" if MENU_READ_ONLY else "")
+
+        if WEBHOOK_BASE_URL:
+            await STOPPING.wait()
+        else:
+            # точка отсчёта для /readyz: первый long poll вернётся только через polling_timeout
+            mark_updates_received()
+            # не больше UPDATE_QUEUE_LIMIT задач: дальше polling ждёт, а не копит апдейты.
+            # Сигналы и закрытие сессии берём на себя — сначала нужно дождаться хендлеров
+            polling = asyncio.create_task(
+                dp.start_polling(
+                    bot,
+                    handle_as_tasks=True,
+                    tasks_concurrency_limit=UPDATE_QUEUE_LIMIT,
+                    handle_signals=False,
+                    close_bot_session=False,
+                )
+            )
+            stopping = asyncio.create_task(STOPPING.wait())
+            await asyncio.wait({polling, stopping}, return_when=asyncio.FIRST_COMPLETED)
+            stopping.cancel()
+            if not polling.done():
+                await dp.stop_polling()
+            await polling
     finally:
-        await runner.cleanup()
+        logger.info("Shutting down")
+        await shutdown(bot, runner, background)
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     asyncio.run(main())
 
 